@@ -1,20 +1,31 @@
 import numpy as np
+import pandas as pd
 class Distance():
     
     @staticmethod
-    def mahalonobis(vector1, table):
-        # Create Covariance Matrix
-        #   calculate covariance between each feature.
-        # sqrt((v1-v2)*covariance*(v1-v2)^T)
-        pass
+    def mahalonobis(vector1, table, shrinkage=0.1):
+        """
+        Mahalanobis distance from vector1 to every row of the table, using the covariance between
+            the features of the table. Refits on every call, use QuadraticForm.mahalanobis directly
+            to query the same table many times.
+        """
+        return QuadraticForm.mahalanobis(table, shrinkage).distance(vector1, table)
 
 
     @staticmethod
-    def quadratic(vector, table):
-        # Calculate similarity matrix
-        #   caluclate similarity between each feature.
-        # sqrt((v1-v2)*covariance*(v1-v2)^T)
-        pass
+    def quadratic(vector, table, similarity=None):
+        """
+        Quadratic form distance sqrt((v1-v2) A (v1-v2)^T) from vector to every row of the table. A
+            is the similarity between features, by default the cosine similarity between the
+            feature columns of the table.
+        """
+        if similarity is None:
+            columns = np.asarray(table, dtype=np.float64)
+            norms = np.linalg.norm(columns, axis=0)
+            norms[norms == 0] = 1
+            columns = columns / norms
+            similarity = columns.T.dot(columns)
+        return QuadraticForm.quadratic(similarity).distance(vector, table)
 
 
     @staticmethod
@@ -23,6 +34,96 @@ class Distance():
         distances = table.sub(vector, axis='columns').abs().pow(p).sum(1).pow(1/p)
         return distances
 
+##
+# Distances of the form sqrt((v1-v2) A (v1-v2)^T), Mahalanobis (A is the inverse covariance) and
+#   quadratic form (A is a feature similarity matrix). A is factorized once as W W^T, so after every
+#   row is multiplied by W once, the distance is a plain Euclidean distance between transformed rows.
+class QuadraticForm():
+
+    def __init__(self, factor):
+        """
+        :param numpy.ndarray factor: (d, r) matrix W with A = W W^T.
+        """
+        self.factor = factor
+        self.ids = None
+        self.rows = None
+
+
+    @staticmethod
+    def mahalanobis(table, shrinkage=0.1):
+        """
+        Mahalanobis distance for the features of the table. The covariance C is shrunk towards a
+            scaled identity, (1 - s) C + s tr(C) / d I, so it is invertible even with about as many
+            features as rows (945 visual features), and factorized as C = L L^T, giving W = L^-T.
+        :param float shrinkage: s, between 0 and 1.
+        """
+        matrix = np.asarray(table, dtype=np.float64)
+        covariance = np.atleast_2d(np.cov(matrix, rowvar=False))
+        d = len(covariance)
+        covariance = (1 - shrinkage) * covariance + shrinkage * np.trace(covariance) / d * np.eye(d)
+        try:
+            factor = np.linalg.inv(np.linalg.cholesky(covariance)).T
+        except np.linalg.LinAlgError:
+            # singular, invert over the nonzero eigenvalues only.
+            values, vectors = np.linalg.eigh(covariance)
+            keep = values > max(values.max(), 0) * d * np.finfo(np.float64).eps
+            factor = vectors[:, keep] / np.sqrt(values[keep])
+        return QuadraticForm(factor)
+
+
+    @staticmethod
+    def quadratic(similarity, shrinkage=0.0):
+        """
+        Quadratic form distance for a (d, d) feature similarity matrix A. A is symmetrized, shrunk
+            like the covariance in mahalanobis and factorized as V diag(l) V^T, giving
+            W = V diag(sqrt(l)). Negative eigenvalues, where A is not positive semidefinite, are
+            dropped.
+        :param float shrinkage: s, between 0 and 1.
+        """
+        similarity = np.asarray(similarity, dtype=np.float64)
+        similarity = (similarity + similarity.T) / 2
+        d = len(similarity)
+        similarity = (1 - shrinkage) * similarity + shrinkage * np.trace(similarity) / d * np.eye(d)
+        values, vectors = np.linalg.eigh(similarity)
+        keep = values > 0
+        return QuadraticForm(vectors[:, keep] * np.sqrt(values[keep]))
+
+
+    def transform(self, vectors):
+        """
+        Vectors (a row or a table) in the space where the distance is Euclidean.
+        """
+        return np.asarray(vectors, dtype=np.float64).dot(self.factor)
+
+
+    def fit(self, table):
+        """
+        Transforms the rows of the table once so knn only has to transform the query.
+        """
+        self.ids = np.asarray(table.index) if hasattr(table, 'index') else np.arange(len(table))
+        self.rows = self.transform(table)
+        return self
+
+
+    def distance(self, vector, table):
+        """
+        Distances from vector to every row of the table.
+        """
+        distances = np.sqrt(np.square(self.transform(table) - self.transform(vector)).sum(axis=1))
+        return pd.Series(distances, index=table.index) if hasattr(table, 'index') else distances
+
+
+    def knn(self, k, vector):
+        """
+        The k fitted rows nearest to vector, a Euclidean top k over the transformed rows.
+        :return tuple: (ids, distances), nearest first.
+        """
+        distances = np.sqrt(np.square(self.rows - self.transform(vector)).sum(axis=1))
+        nearest = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest], kind='mergesort')]
+        return self.ids[nearest], distances[nearest]
+
+
 ##
 # Default Similarity class which uses dictionary keys (feature ids) to compare two vectors. Should
 #   be used as the default similarity measure.
@@ -208,8 +208,8 @@ class Interface():
         neighbors = Neighbor.knn(j, vector, reduced_table)
         neighbors_str = ""
         neighbors_str += "NEIGHBORS to " + str(anid)
-        for i, neighbor in enumerate(neighbors):
-            neighbors_str += f"{i}: ID = {neighbor.id}, DIST = {neighbor.dist}"
+        for i, (neighbor, dist) in enumerate(neighbors):
+            neighbors_str += f"{i}: ID = {neighbor}, DIST = {dist}"
         print(neighbors_str)
         return ls_str + '\n' + neighbors_str
 
@@ -263,8 +263,8 @@ class Interface():
         nearest_img = "5 nearest images to " + str(args[3]) + " are:\n"
         nearest = Neighbor.knn_dot(5, vector1, matrix)
         nearest_img += "IMAGE ID\t\tSCORE\n"
-        for values in nearest:
-            nearest_img += str(values[1]) + "\t\t" + str(values[0]) + '\n'
+        for image, score in nearest:
+            nearest_img += str(image) + "\t\t" + str(score) + '\n'
         print(nearest_img)
 
         # Get nearest locations from latent semantics.
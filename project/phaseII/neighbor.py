@@ -1,5 +1,4 @@
 from distance import Distance, Similarity
-from heapq import heappush, merge, nsmallest
 from util import timed
 from numpy.linalg import norm
 from numpy import dot
@@ -13,19 +12,24 @@ from database import Database
 from sklearn.neighbors import KNeighborsClassifier
 
 
-# A class is implemented for this tuple to ensure that
-#   the heapq can compare when appending.
-class DistanceMeasure():
-    def __init__(self, an_id, distance):
-        self.id = an_id
-        self.dist = distance
+class Nearest():
+    """
+    Result of a k nearest search: the ids of the nearest rows and their distances (or scores), \
+        best first, as two arrays. Iterating gives (id, distance) pairs.
+    """
+    def __init__(self, ids, distances):
+        self.ids = np.asarray(ids)
+        self.distances = np.asarray(distances)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return zip(self.ids.tolist(), self.distances.tolist())
 
-    def __lt__(self, other):
-        return self.dist < other.dist
-    
     def __str__(self):
-        return "( id = " + str(self.id) + ", distance = " + str(self.dist) + ")"
-    
+        return "\n".join("( id = " + str(an_id) + ", distance = " + str(dist) + ")" for an_id, dist in self)
+
     def __repr__(self):
         return self.__str__()
 
@@ -33,18 +37,33 @@ class DistanceMeasure():
 class Neighbor():    
 
     @staticmethod
-    def knn_worker(vector, table):
+    def top_k(k, ids, distances, largest=False):
+        """
+        Selects the k smallest distances (largest scores if largest is set) with argpartition and \
+        sorts only those k.
+        :param ids: id of every row.
+        :param numpy.ndarray distances: distance of every row.
+        :return Nearest: the k best rows, best first.
+        """
+        distances = np.asarray(distances)
+        order = -distances if largest else distances
+        if k < len(distances):
+            best = np.argpartition(order, k - 1)[:k]
+        else:
+            best = np.arange(len(distances))
+        best = best[np.argsort(order[best], kind='mergesort')]
+        return Nearest(np.asarray(ids)[best], distances[best])
+
+
+    @staticmethod
+    def knn_worker(k, vector, table):
         """
         Worker for each process of the distance calculation. Runs the actual distance measure \
-        and aggregates the results into heap for fast merge sort with other processes.
+        and keeps the k nearest rows of its part of the table for the merge with other processes.
         """
 
-        dist_table = Distance.l_p_distance(3, vector, table)
-        distances = list()
-        for index in dist_table.index:
-            heappush(distances, DistanceMeasure(index, dist_table[index]))
-        
-        return distances
+        distances = Distance.l_p_distance(3, vector, table)
+        return Neighbor.top_k(k, table.index, np.asarray(distances))
 
 
 
@@ -64,18 +83,16 @@ class Neighbor():
             args = []
             for i in range(processes):
                 subtable = table.iloc[i * size : (i + 1) * size]
-                args.append((vector, subtable))
+                args.append((k, vector, subtable))
             
-            p = Pool(processes)
-            print("Starting threads!")
-            out = p.starmap(Neighbor.knn_worker, args)
-            dists = merge(*out)
-        
-        else:
-            dists = Neighbor.knn_worker(vector, table)
+            with Pool(processes) as p:
+                print("Starting threads!")
+                out = p.starmap(Neighbor.knn_worker, args)
+            # each process returns at most k rows, so the merge only looks at k * processes.
+            return Neighbor.top_k(k, np.concatenate([part.ids for part in out]),
+                                  np.concatenate([part.distances for part in out]))
         
-        nearest = nsmallest(k, dists)
-        return nearest
+        return Neighbor.knn_worker(k, vector, table)
 
 
 
@@ -125,28 +142,14 @@ class Neighbor():
     
     @staticmethod
     def knn_dot(k, vector, table):
-
-        def take_first(elem):
-            return elem[0]
-
-        result = []
+        """
+        Finds the k rows of the table with the largest absolute cosine similarity to the vector.
+        :return Nearest: ids and similarities of the k most similar rows, most similar first.
+        """
         vector = np.array(vector)
-        indexes = table.index
-        table = np.array(table)
-        i = 0
-        for other_vector in table:
-            other_vector_id = indexes[i]
-            i = i + 1
-            other_vector = np.array(other_vector)
-            similarity = abs(dot(vector, other_vector))
-            similarity = similarity/(norm(vector)*norm(other_vector))
-            result.append([similarity, other_vector_id])
-
-        result.sort(key=take_first)
-        result.reverse()
-        nearest = result[0:k]
-
-        return nearest
+        matrix = np.array(table)
+        similarity = np.abs(matrix.dot(vector)) / (norm(vector) * norm(matrix, axis=1))
+        return Neighbor.top_k(k, table.index, similarity, largest=True)
 
     @staticmethod
     def knn_vd(n, this_matrix, vis_model, k, method, this_matrix_id, database):
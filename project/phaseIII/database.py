@@ -1,12 +1,14 @@
 #! /bin/usr/python3.6
 
 import pandas as pd
+import numpy as np
 from os import listdir, mkdir
 from os.path import basename, join, isfile, splitext, split, isdir, abspath
 from csv import reader
 from util import timed
 from collections import defaultdict
 import pickle
+import atexit
 
 class Database():
 
@@ -16,6 +18,9 @@ class Database():
         self.source = source # indicates the dataset file location. 
         self.vis_descriptors = {}
         self.vis = None
+        self.vis_matrix = None
+        # shared memory block backing vis_matrix, see share_vis_matrix.
+        self.vis_memory = None
         # self.txt_descriptors = {}
         self.locations = None
         self.vis_models = ['CM', 'CM3x3', 'CN', 'CN3x3', 'CSD', 'GLRLM', 'GLRLM3x3', 'HOG', 'LBP', 'LBP3x3']
@@ -116,6 +121,7 @@ class Database():
         if isfile(path):
             self.vis_descriptors = None
             self.vis = pd.read_pickle(path)
+            self.__reset_vis_matrix__()
             with open(abspath(join(subdir, 'loc.pickle')), 'rb') as f:
                 self.loc_map = pickle.load(f)
             print('Visual Descriptors Loaded...')
@@ -136,6 +142,7 @@ class Database():
 
         # Set as combined table.        
         self.vis = self.get_vis_table()
+        self.__reset_vis_matrix__()
         file_loc = abspath(join(subdir, 'visdata.pickle'))
         self.vis.to_pickle(file_loc)
         with open(abspath(join(subdir, 'loc.pickle')), 'wb+') as f:
@@ -301,6 +308,46 @@ class Database():
             return table.to_sparse().fillna(0)
 
 
+    def get_vis_matrix(self):
+        """
+        Phase III visual table as numpy arrays (ids, matrix), converted once and cached. Row i of
+            the float matrix is the descriptor of image ids[i].
+        """
+        if self.vis_matrix is None:
+            table = self.get_vis_table()
+            self.vis_matrix = (np.asarray(table.index), np.asarray(table.values, dtype=np.float64))
+        return self.vis_matrix
+
+
+    def share_vis_matrix(self):
+        """
+        Moves the visual matrix into shared memory so worker processes can attach to it by name,
+            and serves it from there afterwards, so the session holds a single copy. Needs Python 3.8.
+        :return tuple: (ids, matrix, name of the shared memory block).
+        """
+        ids, matrix = self.get_vis_matrix()
+        if self.vis_memory is None:
+            from multiprocessing.shared_memory import SharedMemory
+            self.vis_memory = SharedMemory(create=True, size=max(1, matrix.nbytes))
+            shared = np.ndarray(matrix.shape, dtype=np.float64, buffer=self.vis_memory.buf)
+            shared[:] = matrix
+            self.vis_matrix = (ids, shared)
+            atexit.register(self.vis_memory.unlink)
+        return self.vis_matrix[0], self.vis_matrix[1], self.vis_memory.name
+
+
+    def __reset_vis_matrix__(self):
+        """
+        Drops the cached visual matrix, and the name of its shared memory block if it has one. The
+            block itself is freed once nothing maps it anymore.
+        """
+        self.vis_matrix = None
+        if self.vis_memory is not None:
+            atexit.unregister(self.vis_memory.unlink)
+            self.vis_memory.unlink()
+            self.vis_memory = None
+
+
     # Get vector corresponding to the photo id  based on the locationid and model.
     #   If model is none, the tables will be combined to get a vector for 
     #   every model.
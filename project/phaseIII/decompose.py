@@ -8,6 +8,10 @@ from util import timed
 from functools import wraps
 import numpy as np
 from sklearn.preprocessing import MinMaxScaler
+from scipy.sparse import csr_matrix, diags, identity
+from scipy.sparse.linalg import eigsh
+from os.path import isfile
+from hashlib import md5
 
 
 
@@ -112,3 +116,64 @@ class Decompose():
             table = DataFrame(table, columns=cols, index=indexes)
         reduced, ps = Decompose.switchboard(table, k, method)
         return reduced, ps
+
+
+    @staticmethod
+    @timed
+    def spectral_embedding(adjacency, k, normalized=False, cache=None):
+        """
+        Finds the k smallest eigenpairs of the graph Laplacian with a sparse iterative solver. The
+            adjacency is symmetrized as (A + A^T) / 2 first. Only the k needed eigenpairs are
+            computed, never the dense n x n decomposition.
+        :param scipy.sparse.csr_matrix adjacency: (n, n) adjacency matrix of the graph.
+        :param int k: number of eigenpairs to compute.
+        :param bool normalized: use I - D^-1/2 S D^-1/2 instead of D - S.
+        :param path cache: npz file holding an earlier embedding. It is reused if it was built for the
+            same graph and setting with at least k vectors, and rewritten otherwise.
+        :return tuple: (values, vectors) with the eigenvalues ascending and vectors as (n, k) columns.
+        """
+        S = csr_matrix(adjacency, dtype=np.float64)
+        S = (S + S.T) / 2
+        S.sum_duplicates()
+        S.sort_indices()
+        n = S.shape[0]
+        k = min(k, n)
+
+        # digest of the symmetrized adjacency, so a cache built for another graph is not reused.
+        digest = md5(np.array(S.shape).tobytes())
+        for array in (S.indptr, S.indices, S.data):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest = digest.hexdigest()
+
+        if cache and isfile(cache):
+            with np.load(cache) as data:
+                if 'digest' in data and str(data['digest']) == digest and bool(data['normalized']) == normalized \
+                        and len(data['values']) >= k:
+                    print('Reusing spectral embedding from %s' % cache)
+                    return data['values'][:k], data['vectors'][:, :k]
+
+        degree = np.ravel(S.sum(axis=1))
+        if normalized:
+            inv_sqrt = np.zeros(n)
+            inv_sqrt[degree > 0] = 1 / np.sqrt(degree[degree > 0])
+            # smallest eigenvalues of I - M are the largest of M.
+            M = diags(inv_sqrt).dot(S).dot(diags(inv_sqrt))
+            shift = 1.0
+        else:
+            # shift by a Gershgorin bound on the largest eigenvalue so the smallest become largest.
+            shift = 2 * degree.max() if n else 0
+            M = shift * identity(n, format='csr') - (diags(degree) - S)
+
+        if k < n - 1:
+            mu, vectors = eigsh(M, k, which='LA')
+        else:
+            # eigsh needs k < n, tiny graphs fall back to the dense solver.
+            mu, vectors = np.linalg.eigh(M.toarray())
+            mu, vectors = mu[n - k:], vectors[:, n - k:]
+        values = shift - mu
+        order = np.argsort(values)
+        values, vectors = values[order], vectors[:, order]
+
+        if cache:
+            np.savez(cache, values=values, vectors=vectors, normalized=normalized, digest=digest)
+        return values, vectors
@@ -4,32 +4,197 @@ import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 import pandas as pd
 from util import timed
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 class Distance():
     
     @staticmethod
-    def mahalonobis(vector1, table):
-        # Create Covariance Matrix
-        #   calculate covariance between each feature.
-        # sqrt((v1-v2)*covariance*(v1-v2)^T)
-        pass
+    def mahalonobis(vector1, table, shrinkage=0.1):
+        """
+        Mahalanobis distance from vector1 to every row of the table, using the covariance between
+            the features of the table. Refits on every call, use QuadraticForm.mahalanobis directly
+            to query the same table many times.
+        """
+        return QuadraticForm.mahalanobis(table, shrinkage).distance(vector1, table)
 
 
     @staticmethod
-    def quadratic(vector, table):
-        # Calculate similarity matrix
-        #   caluclate similarity between each feature.
-        # sqrt((v1-v2)*covariance*(v1-v2)^T)
-        pass
+    def quadratic(vector, table, similarity=None):
+        """
+        Quadratic form distance sqrt((v1-v2) A (v1-v2)^T) from vector to every row of the table. A
+            is the similarity between features, by default the cosine similarity between the
+            feature columns of the table.
+        """
+        if similarity is None:
+            columns = np.asarray(table, dtype=np.float64)
+            norms = np.linalg.norm(columns, axis=0)
+            norms[norms == 0] = 1
+            columns = columns / norms
+            similarity = columns.T.dot(columns)
+        return QuadraticForm.quadratic(similarity).distance(vector, table)
 
 
     @staticmethod
     def l_p_distance(p, vector, table, positional=False):
 
-        distances = table.sub(vector, axis='columns').abs().pow(p).sum(1).pow(1/p)
-        return distances
-    
-   @staticmethod
+        if isinstance(table, np.ndarray):
+            # plain arrays, one distance per row.
+            return Distance.l_p_pairwise(p, np.asarray(vector)[np.newaxis], table)[0]
+        if isinstance(vector, pd.Series):
+            vector = vector.reindex(table.columns)
+        distances = Distance.l_p_pairwise(p, np.asarray(vector, dtype=np.float64)[np.newaxis], table.values)[0]
+        return pd.Series(distances, index=table.index)
+
+
+    @staticmethod
+    def l_p_pairwise(p, queries, table, k=None, mask=None, block_size=2 ** 20, dtype=np.float64):
+        """
+        L_p distances from every query to every row of the table, a tile of queries by rows at a
+            time in buffers allocated once, so memory stays at one tile instead of one temporary
+            per operation. p = 2 with several queries is a matrix product, p = 1, 2 and 3 otherwise
+            avoid the general power.
+        :param numpy.ndarray queries: (q, d) query vectors.
+        :param numpy.ndarray table: (n, d) rows to compare against.
+        :param int k: if given, only the k nearest rows of every query are kept, tile by tile.
+        :param numpy.ndarray mask: optional (q, d) weights of the columns for each query, e.g.
+            queries != 0 to compare only the columns present in each query.
+        :param int block_size: number of elements in a tile buffer.
+        :param dtype: float32 halves the memory traffic, float64 by default.
+        :return numpy.ndarray or tuple: (q, n) distances, or with k the (q, k) row positions and
+            (q, k) distances of the nearest rows, nearest first.
+        """
+        queries = np.asarray(queries, dtype=dtype)
+        table = np.asarray(table, dtype=dtype)
+        mask = None if mask is None else np.asarray(mask, dtype=dtype)
+        (q, d), n = queries.shape, table.shape[0]
+        q_step = min(q, 16) or 1
+        n_step = max(1, min(n, block_size // (q_step * max(d, 1))))
+
+        # the product form loses precision near 0, only worth it when queries share the table.
+        product = p == 2 and q > 1
+        if product:
+            squares = table * table
+        else:
+            buffer = np.empty((q_step, n_step, d), dtype=dtype)
+            cubes = np.empty_like(buffer) if p == 3 else None
+            tile = np.empty((q_step, n_step), dtype=dtype)
+
+        if k is None:
+            out = np.empty((q, n), dtype=dtype)
+        else:
+            k = min(k, n)
+            positions = np.empty((q, k), dtype=np.int64)
+            nearest = np.empty((q, k), dtype=dtype)
+
+        for q_start in range(0, q, q_step):
+            Q = queries[q_start:q_start + q_step]
+            M = None if mask is None else mask[q_start:q_start + q_step]
+            best = np.full((len(Q), 0), np.inf, dtype=dtype)
+            best_rows = np.empty((len(Q), 0), dtype=np.int64)
+            for n_start in range(0, n, n_step):
+                X = table[n_start:n_start + n_step]
+                if product:
+                    # sum m (q - x)^2 = sum m q^2 - 2 (m q) . x + m . x^2, the product is the tile.
+                    if M is None:
+                        result = Q.dot(X.T)
+                        result *= -2
+                        result += (Q * Q).sum(axis=1)[:, np.newaxis]
+                        result += squares[n_start:n_start + n_step].sum(axis=1)
+                    else:
+                        result = (M * Q).dot(X.T)
+                        result *= -2
+                        result += (M * Q * Q).sum(axis=1)[:, np.newaxis]
+                        result += M.dot(squares[n_start:n_start + n_step].T)
+                    np.maximum(result, 0, out=result)
+                else:
+                    result = tile[:len(Q), :len(X)]
+                    terms = buffer[:len(Q), :len(X)]
+                    np.subtract(Q[:, np.newaxis], X[np.newaxis], out=terms)
+                    Distance.l_p_terms(p, terms, None if cubes is None else cubes[:len(Q), :len(X)])
+                    if M is not None:
+                        terms *= M[:, np.newaxis]
+                    terms.sum(axis=2, out=result)
+
+                if k is None:
+                    out[q_start:q_start + len(Q), n_start:n_start + len(X)] = result
+                else:
+                    # keep the k nearest of the previous best and this tile.
+                    best = np.hstack((best, result))
+                    best_rows = np.hstack((best_rows, np.broadcast_to(np.arange(n_start, n_start + len(X)), result.shape)))
+                    if best.shape[1] > k:
+                        part = np.argpartition(best, k - 1, axis=1)[:, :k]
+                        best = np.take_along_axis(best, part, axis=1)
+                        best_rows = np.take_along_axis(best_rows, part, axis=1)
+
+            if k is not None:
+                order = np.argsort(best, axis=1, kind='mergesort')
+                positions[q_start:q_start + len(Q)] = np.take_along_axis(best_rows, order, axis=1)
+                nearest[q_start:q_start + len(Q)] = np.take_along_axis(best, order, axis=1)
+
+        distances = out if k is None else nearest
+        if p != 1:
+            np.power(distances, 1. / p, out=distances)
+        return distances if k is None else (positions, distances)
+
+    @staticmethod
+    def l_p_terms(p, terms, scratch=None):
+        """
+        Turns differences into L_p terms |x|^p in place. p = 1, 2 and 3 avoid the general power,
+            p = 3 multiplies twice through scratch, a buffer of the same shape.
+        :param numpy.ndarray terms: differences, overwritten with the terms.
+        :return numpy.ndarray: terms.
+        """
+        np.abs(terms, out=terms)
+        if p == 2:
+            terms *= terms
+        elif p == 3:
+            np.multiply(terms, terms, out=scratch)
+            terms *= scratch
+        elif p != 1:
+            np.power(terms, p, out=terms)
+        return terms
+
+    @staticmethod
+    def l_p_paired(p, queries, table, owners, rows, mask=None, block_size=2 ** 20, dtype=np.float64):
+        """
+        L_p distance of every (query, row) pair, from queries[owners[i]] to table[rows[i]], without
+            gathering all the pairs at once. The pairs go through buffers of block_size elements
+            allocated once.
+        :param numpy.ndarray queries: (q, d) query vectors.
+        :param numpy.ndarray table: (n, d) rows to compare against.
+        :param numpy.ndarray owners: query position of every pair.
+        :param numpy.ndarray rows: table row position of every pair.
+        :param numpy.ndarray mask: optional (q, d) weights of the columns for each query.
+        :return numpy.ndarray: distance of every pair.
+        """
+        queries = np.asarray(queries, dtype=dtype)
+        table = np.asarray(table, dtype=dtype)
+        mask = None if mask is None else np.asarray(mask, dtype=dtype)
+        owners, rows = np.asarray(owners, dtype=np.intp), np.asarray(rows, dtype=np.intp)
+        d = queries.shape[1]
+        step = max(1, min(len(rows), block_size // max(d, 1)))
+        buffer = np.empty((step, d), dtype=dtype)
+        scratch = np.empty_like(buffer)
+        out = np.empty(len(rows), dtype=dtype)
+
+        for start in range(0, len(rows), step):
+            stop = min(start + step, len(rows))
+            terms, other = buffer[:stop - start], scratch[:stop - start]
+            np.take(table, rows[start:stop], axis=0, out=terms)
+            np.take(queries, owners[start:stop], axis=0, out=other)
+            terms -= other
+            Distance.l_p_terms(p, terms, other)
+            if mask is not None:
+                np.take(mask, owners[start:stop], axis=0, out=other)
+                terms *= other
+            terms.sum(axis=1, out=out[start:stop])
+
+        if p != 1:
+            np.power(out, 1. / p, out=out)
+        return out
+
+    @staticmethod
     def E_distance(vector1, vector2):
         vector1 = np.array(vector1, dtype=np.float)
         vector2 = np.array(vector2, dtype=np.float)
@@ -43,6 +208,94 @@ class Distance():
         distances = np.sqrt(np.sum(np.power((vector1 - vector2), 2)))
         return distances
 
+##
+# Distances of the form sqrt((v1-v2) A (v1-v2)^T), Mahalanobis (A is the inverse covariance) and
+#   quadratic form (A is a feature similarity matrix). A is factorized once as W W^T, so after every
+#   row is multiplied by W once, the distance is a plain Euclidean distance between transformed rows.
+class QuadraticForm():
+
+    def __init__(self, factor):
+        """
+        :param numpy.ndarray factor: (d, r) matrix W with A = W W^T.
+        """
+        self.factor = factor
+        self.ids = None
+        self.rows = None
+
+
+    @staticmethod
+    def mahalanobis(table, shrinkage=0.1):
+        """
+        Mahalanobis distance for the features of the table. The covariance C is shrunk towards a
+            scaled identity, (1 - s) C + s tr(C) / d I, so it is invertible even with about as many
+            features as rows (945 visual features), and factorized as C = L L^T, giving W = L^-T.
+        :param float shrinkage: s, between 0 and 1.
+        """
+        matrix = np.asarray(table, dtype=np.float64)
+        covariance = np.atleast_2d(np.cov(matrix, rowvar=False))
+        d = len(covariance)
+        covariance = (1 - shrinkage) * covariance + shrinkage * np.trace(covariance) / d * np.eye(d)
+        try:
+            factor = np.linalg.inv(np.linalg.cholesky(covariance)).T
+        except np.linalg.LinAlgError:
+            # singular, invert over the nonzero eigenvalues only.
+            values, vectors = np.linalg.eigh(covariance)
+            keep = values > max(values.max(), 0) * d * np.finfo(np.float64).eps
+            factor = vectors[:, keep] / np.sqrt(values[keep])
+        return QuadraticForm(factor)
+
+
+    @staticmethod
+    def quadratic(similarity, shrinkage=0.0):
+        """
+        Quadratic form distance for a (d, d) feature similarity matrix A. A is symmetrized, shrunk
+            like the covariance in mahalanobis and factorized as V diag(l) V^T, giving
+            W = V diag(sqrt(l)). Negative eigenvalues, where A is not positive semidefinite, are
+            dropped.
+        :param float shrinkage: s, between 0 and 1.
+        """
+        similarity = np.asarray(similarity, dtype=np.float64)
+        similarity = (similarity + similarity.T) / 2
+        d = len(similarity)
+        similarity = (1 - shrinkage) * similarity + shrinkage * np.trace(similarity) / d * np.eye(d)
+        values, vectors = np.linalg.eigh(similarity)
+        keep = values > 0
+        return QuadraticForm(vectors[:, keep] * np.sqrt(values[keep]))
+
+
+    def transform(self, vectors):
+        """
+        Vectors (a row or a table) in the space where the distance is Euclidean.
+        """
+        return np.asarray(vectors, dtype=np.float64).dot(self.factor)
+
+
+    def fit(self, table):
+        """
+        Transforms the rows of the table once so knn only has to transform the query.
+        """
+        self.ids = np.asarray(table.index) if hasattr(table, 'index') else np.arange(len(table))
+        self.rows = self.transform(table)
+        return self
+
+
+    def distance(self, vector, table):
+        """
+        Distances from vector to every row of the table.
+        """
+        distances = Distance.l_p_pairwise(2, self.transform(vector)[np.newaxis], self.transform(table))[0]
+        return pd.Series(distances, index=table.index) if hasattr(table, 'index') else distances
+
+
+    def knn(self, k, vector):
+        """
+        The k fitted rows nearest to vector, a Euclidean top k over the transformed rows.
+        :return tuple: (ids, distances), nearest first.
+        """
+        positions, distances = Distance.l_p_pairwise(2, self.transform(vector)[np.newaxis], self.rows, k=k)
+        return self.ids[positions[0]], distances[0]
+
+
 ##
 # Default Similarity class which uses dictionary keys (feature ids) to compare two vectors. Should
 #   be used as the default similarity measure.
@@ -69,6 +322,60 @@ class Similarity():
         similarity = cosine_similarity(table1, table2)
 
         return pd.DataFrame(data=similarity, index=index1, columns=index2)
+
+    @staticmethod
+    @timed
+    def cosine_top_k(table, k, block_size=None, processes=None, memory=2 ** 26):
+        """
+        Finds the k most cosine similar rows for every row of the table without building the full
+            similarity matrix. Rows are compared against the table a block at a time and only the
+            top k of each row survive the block, so memory stays O(n * k) plus one block x n slab
+            per worker, all the slabs together within the memory budget.
+        :param Pandas.Dataframe table: rows to compare against each other.
+        :param int k: number of most similar rows to keep per row. Self similarity is excluded.
+        :param int block_size: number of rows compared against the table at once. By default as
+            many as keep every worker's slab within the memory budget.
+        :param int processes: number of worker threads. If None, uses every available core.
+        :param int memory: bytes allowed for the slabs of all the workers together.
+        :return tuple: (ids, neighbors, weights) where neighbors is an (n, k) array of row positions
+            and weights the matching (n, k) similarities, each row sorted most similar first.
+        """
+        ids = np.asarray(table.index)
+        matrix = np.asarray(table.values, dtype=np.float64)
+        n = matrix.shape[0]
+        k = min(k, n - 1)
+        if k < 1:
+            raise ValueError('At least two rows and k >= 1 are needed to find similar rows.')
+        processes = processes or cpu_count()
+        if block_size is None:
+            block_size = max(1, memory // (8 * n * processes))
+
+        # normalize once so every block is a plain matrix product.
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1
+        matrix = matrix / norms[:, np.newaxis]
+
+        neighbors = np.empty((n, k), dtype=np.int64)
+        weights = np.empty((n, k), dtype=np.float64)
+
+        def block(start):
+            end = min(start + block_size, n)
+            sim = matrix[start:end].dot(matrix.T)
+            for i, row in enumerate(sim, start):
+                row[i] = -np.inf
+                # partial selection of the k largest a row at a time, so only one row of positions
+                #   exists next to the slab, then sort only those k.
+                part = np.argpartition(row, n - k)[n - k:]
+                part = part[np.argsort(-row[part], kind='mergesort')]
+                neighbors[i] = part
+                weights[i] = row[part]
+
+        # numpy releases the GIL for the products and partitions, so threads share the matrix.
+        pool = ThreadPool(processes)
+        pool.map(block, range(0, n, block_size))
+        pool.close()
+        pool.join()
+        return ids, neighbors, weights
     
     # finds similarity between two vectors (numpy arrays)
     @staticmethod
@@ -1,12 +1,14 @@
 #! /bin/usr/python3.6
 import igraph
 # igraph also requires pycairo
-from os.path import isfile
+from os.path import isfile, isdir
 from util import timed
 from functools import wraps
 import pickle
 from collections import defaultdict
 import pandas as pd
+import numpy as np
+from scipy.sparse import csr_matrix
 from distance import Similarity
 from sys import stdout
 
@@ -48,6 +50,8 @@ class Graph():
 
         # data structor to store nodes in a given cluster for faster access.
         self.clusters = {}
+        # hash index from node name to vertex index so lookups don't scan the vertex sequence.
+        self.__reindex__()
 
         if not similarity is None:
             self.add_similarity(similarity)
@@ -59,6 +63,28 @@ class Graph():
     ###########################################################################################
     
 
+    def __reindex__(self):
+        """
+        Rebuilds the name to vertex index dictionary from the graph.
+        """
+        if 'name' in self.__graph__.vs.attributes():
+            names = self.__graph__.vs['name']
+        else:
+            names = []
+        self.__index__ = {name: i for i, name in enumerate(names)}
+
+
+    def __get_index__(self, name):
+        """
+        retrieve the vertex index of a node by its name.
+        :param obj name: identifier for this node.
+        """
+        try:
+            return self.__index__[name]
+        except KeyError:
+            raise ValueError('The node name provided couldn\'t be found or is repeated: %s' % name)
+
+
     def __add_edges__(self, edges, weights, graph=None):
         """
         Add edges from standard notation (start, end) and weight companion list.
@@ -68,23 +94,54 @@ class Graph():
         if graph is None:
             graph = self.__graph__
 
-        # translate from name tuples to object tuples
-        edges = [(self.__get_node_by_name__(e1), self.__get_node_by_name__(e2)) for e1, e2 in edges]
+        # translate from name tuples to index tuples
+        edges = [(self.__get_index__(e1), self.__get_index__(e2)) for e1, e2 in edges]
+        self.__append_edges__(edges, weights, graph)
+        return
 
-        # get base list based on if list exists or not. Probably a cleaner way to do this.
-        num_edges = len(graph.es)
-        if num_edges == 0:
-            temp_weights = list()
-        else:
-            temp_weights = graph.es[Graph.SIM]
-        temp_weights.extend(weights)
 
+    def __append_edges__(self, edges, weights, graph=None):
+        """
+        Append edges between vertex indices in one igraph call and set the weights of only the new
+            edges, so existing weights are never rebuilt. A (start, end) pair already in the graph
+            or repeated in edges raises a ValueError instead of becoming a parallel edge.
+        :param list edges: list of (start, end) vertex index tuples.
+        :param list weights: list of floats.
+        """
+        if graph is None:
+            graph = self.__graph__
+
+        repeated = Graph.repeated_edges(graph.vcount(), edges, graph.get_edgelist())
+        if len(repeated):
+            names = graph.vs['name']
+            raise ValueError('The edges provided are repeated: %s'
+                             % [(names[edges[i][0]], names[edges[i][1]]) for i in repeated[:10]])
+
+        start = graph.ecount()
         graph.add_edges(edges)
-        graph.es[Graph.SIM] = temp_weights
-        return
+        graph.es.select(range(start, graph.ecount()))[Graph.SIM] = list(weights)
 
 
 
+    @staticmethod
+    def repeated_edges(n, edges, existing=()):
+        """
+        Positions of the edges whose (start, end) pair appears earlier in edges or among the
+            existing ones. Both backends refuse these, so neither keeps parallel edges nor sums them.
+        :param int n: number of vertices.
+        :param list edges: (start, end) vertex index pairs to add.
+        :param list existing: (start, end) vertex index pairs already in the graph.
+        :return numpy.ndarray: positions of the repeated pairs in edges.
+        """
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        existing = np.asarray(existing, dtype=np.int64).reshape(-1, 2)
+        keys = edges[:, 0] * n + edges[:, 1]
+        repeated = np.isin(keys, existing[:, 0] * n + existing[:, 1])
+        _, first = np.unique(keys, return_index=True)
+        repeated[np.setdiff1d(np.arange(len(keys)), first)] = True
+        return np.flatnonzero(repeated)
+
+
     def __find_edge__(self, start_node, end_node, graph=None):
         """
         find edge by its end points
@@ -94,11 +151,13 @@ class Graph():
         if graph is None:
             graph = self.__graph__
 
-        start = self.__get_node_by_name__(start_node)
-        end = self.__get_node_by_name__(end_node)
+        start = self.__get_index__(start_node)
+        end = self.__get_index__(end_node)
 
-        edges = graph.es.find(_source=start.index, _target=end.index)
-        return edges
+        eid = graph.get_eid(start, end, error=False)
+        if eid < 0:
+            return None
+        return graph.es[eid]
     
 
     def __add_label__(self, node, label, value, graph=None):
@@ -121,8 +180,8 @@ class Graph():
         retrieve a node by its name.
         :param obj name: identifier for this node.
         """
-        if graph is None:
-            graph = self.__graph__
+        if graph is None or graph is self.__graph__:
+            return self.__graph__.vs[self.__get_index__(name)]
         node = graph.vs.select(name=name) 
         if len(node) != 1:
             raise ValueError('The node name provided couldn\'t be found or is repeated: %s' % name)
@@ -155,8 +214,17 @@ class Graph():
         if not isinstance(vertices, list):
             raise ValueError('Vertices parameters should be a list of names.')
 
-        for vertex in vertices:
-            self.__graph__.add_vertex(name=vertex, cluster=None)
+        start = self.__graph__.vcount()
+        index = {vertex: start + i for i, vertex in enumerate(vertices)}
+        repeated = [vertex for vertex in index if vertex in self.__index__]
+        if repeated or len(index) != len(vertices):
+            raise ValueError('The node names provided are repeated: %s' % repeated)
+        self.__index__.update(index)
+
+        self.__graph__.add_vertices(len(vertices))
+        new = self.__graph__.vs.select(range(start, start + len(vertices)))
+        new['name'] = vertices
+        new[Graph.CLUSTER] = [None] * len(vertices)
 
 
     @timed 
@@ -170,14 +238,14 @@ class Graph():
         # TODO photo too large for C int, breaks igraph lib.
         photos = list(similarity.index)
         self.add_vertices(photos)
-        # get the nearest neighbors similarity wise to each image and add to database.
-        for i, photo in enumerate(photos):
-            print(str(i))
-            photo = int(photo)
-            row = similarity.loc[photo].sort_values(ascending=False)
-            edges = [(photo, int(other)) for other in row.index]
-            weights = [other for other in row]
-            self.__add_edges__(edges, weights)
+        # get the nearest neighbors similarity wise to each image and add them all at once.
+        values = np.asarray(similarity.values)
+        order = np.argsort(-values, axis=1, kind='mergesort')
+        ids = np.asarray(similarity.index)
+        src = np.repeat(ids, values.shape[1])
+        dst = ids[order].ravel()
+        weights = np.take_along_axis(values, order, axis=1).ravel()
+        self.add_edge_arrays(src, dst, weights)
         return
     
 
@@ -189,15 +257,39 @@ class Graph():
         """
         nodes = list(edge_dict.keys())
         # form edges.
-        edges = list()
+        src = list()
+        dst = list()
         weights = list()
         for node in nodes:
-            edges.extend([(node, other) for other in edge_dict[node]])
-            weights.extend([edge_dict[node][other] for other in edge_dict[node]])
+            src.extend([node] * len(edge_dict[node]))
+            dst.extend(edge_dict[node].keys())
+            weights.extend(edge_dict[node].values())
         self.add_vertices(nodes)
-        self.__add_edges__(edges, weights)
+        self.add_edge_arrays(np.array(src), np.array(dst), np.array(weights))
         return
 
+
+    def add_edge_arrays(self, src, dst, weights):
+        """
+        Adds edges in bulk from parallel arrays. Names are resolved to vertices in one vectorized
+            pass and every edge and weight is appended with a single igraph call. Each (src, dst)
+            pair can be added once, a repeated pair raises a ValueError, same as SparseGraph.
+        :param numpy.ndarray src: names of the start nodes.
+        :param numpy.ndarray dst: names of the end nodes.
+        :param numpy.ndarray weights: weight of each edge.
+        """
+        if not len(src) == len(dst) == len(weights):
+            raise ValueError('Source, destination and weight arrays must be the same length.')
+
+        names = pd.Index(self.__graph__.vs['name'] if self.__graph__.vcount() else [])
+        start = names.get_indexer(src)
+        end = names.get_indexer(dst)
+        if (start < 0).any() or (end < 0).any():
+            missing = np.concatenate((np.asarray(src)[start < 0], np.asarray(dst)[end < 0]))
+            raise ValueError('The node names provided couldn\'t be found: %s' % missing[:10])
+
+        self.__append_edges__(np.column_stack((start, end)).tolist(), np.asarray(weights).tolist())
+
     
 
     def get_images(self):
@@ -228,20 +320,24 @@ class Graph():
 
     def subgraph(self, out_degree):
         """
-        NOTE: Untested!
         Returns a subgraph of the main graph with max out degree of k.
         When removing edges it keeps the largest k.
         :param int out_degree: number of out edges for each vertex.
         """
         subgraph = self.__graph__.copy()
-        for vertex in subgraph.vs:
-            edges = [subgraph.es[i] for i in subgraph.incident(vertex, mode=igraph.OUT)]
-            while vertex.outdegree > out_degree:
-                # find and remove edge with smallest weight.
-                # NOTE: Removing edge is simple as getting the object and calling .delete()
-                min_edge = min(edges, key=lambda a: a[Graph.SIM])
-                min_edge.delete()
-        return subgraph
+        weights = subgraph.es[Graph.SIM] if subgraph.ecount() else []
+        remove = []
+        for vertex in range(subgraph.vcount()):
+            edges = subgraph.incident(vertex, mode=igraph.OUT)
+            if len(edges) > out_degree:
+                # drop every edge past the largest out_degree weights.
+                edges = sorted(edges, key=lambda e: weights[e], reverse=True)
+                remove.extend(edges[out_degree:])
+        subgraph.delete_edges(remove)
+
+        graph = Graph(graph=subgraph)
+        graph.clusters = {cluster: list(nodes) for cluster, nodes in self.clusters.items()}
+        return graph
 
     
     def neighbors(self, node, clusters=[]):
@@ -251,21 +347,19 @@ class Graph():
         :param list clusters: iterable of clusters to search for neighbors in.
         :return list edges: returns list of edges to neighboring nodes, indicating the similarity.
         """
-        n = self.__get_node_by_name__(node)
-        neighbors = n.neighbors(mode='OUT')
+        graph = self.__graph__
+        edges = graph.incident(self.__get_index__(node), mode=igraph.OUT)
 
         # if a set of clusters were specified, then limit neighbors to only those in the clusters.
         if clusters:
-            temp = []
+            members = set()
             for cluster in clusters:
-                vertices = self.clusters[cluster]
-                intersection = [i for i in neighbors if i in vertices]
-                temp.extend(intersection)
-                [neighbors.remove(i) for i in intersection] # for efficiency
-            neighbors = temp
+                members.update(self.__get_index__(n) for n in self.clusters[cluster])
+            edges = [e for e in edges if graph.es[e].target in members]
         
         # turn into Edge interface object.
-        return_val = [self.edge(node, neighbor['name']) for neighbor in neighbors]
+        names = graph.vs['name']
+        return_val = [Edge(node, names[graph.es[e].target], graph.es[e][Graph.SIM]) for e in edges]
         
         return return_val
 
@@ -332,12 +426,27 @@ class Graph():
     
 
 
-    def get_adjacency(self, graph=None, weighted=False):
+    def get_adjacency(self, graph=None, weighted=False, sparse=False):
         """
+        Adjacency matrix of the graph.
+        :param igraph graph: graph to use. If None, uses main graph.
+        :param bool weighted: use the edge weights instead of 1 for each edge.
+        :param bool sparse: build a scipy CSR matrix straight from the edge list instead of a dense
+            DataFrame. Returns (matrix, ids) where ids lists the node name of each row/column.
         """
         if graph is None:
             graph = self.__graph__
 
+        if sparse:
+            n = graph.vcount()
+            edges = np.array(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+            if weighted:
+                data = np.array(graph.es[Graph.SIM] if len(edges) else [], dtype=np.float64)
+            else:
+                data = np.ones(len(edges), dtype=np.int64)
+            a = csr_matrix((data, (edges[:, 0], edges[:, 1])), shape=(n, n))
+            return a, graph.vs['name']
+
         param_dict = {}
         if weighted:
             param_dict['attribute'] = Graph.SIM
@@ -443,21 +552,93 @@ class Graph():
     
 
     @staticmethod
-    def load(location):
+    def load(location, k=None):
         """
-        Load graph from binary.
+        Load graph from binary, from a SparseGraph snapshot directory, or from the k nearest
+            neighbor table (knn.npz) written by Loader.make_graphs.
         :param path location: location to read from. 
-        """
+        :param int k: with a knn.npz table, the number of neighbors per node. All of them if None.
+        """
+        if location.endswith('.npz'):
+            table = KNNTable.load(location)
+            return table.to_graph(table.k if k is None else k)
+        if isdir(location):
+            # snapshot directory written by SparseGraph.save.
+            from sparse_graph import SparseGraph
+            return SparseGraph.load(location).to_graph()
         if not isfile(location):
             raise FileNotFoundError('The location specified does not exist: %s' % location)
         g = igraph.Graph.Read_Pickle(fname=location)
-        # create clusters dictionary again
+        # create clusters dictionary again, the name index is rebuilt by the constructor.
         graph = Graph(graph=g)
         with open(location + '_dict', 'rb') as f:
             graph.clusters = pickle.load(f)
         return graph
 
 
+class KNNTable():
+    """
+    Nested family of k nearest neighbor graphs. Every node keeps its neighbors sorted most similar
+        first in compact (n, k) arrays, so the graph for any k' <= k is just the first k' columns.
+    """
+
+    def __init__(self, ids, neighbors, weights):
+        """
+        :param numpy.ndarray ids: node names, one per row.
+        :param numpy.ndarray neighbors: (n, k) row positions of each node's neighbors, most similar first.
+        :param numpy.ndarray weights: (n, k) similarity of each neighbor, aligned with neighbors.
+        """
+        if neighbors.shape != weights.shape or neighbors.shape[0] != len(ids):
+            raise ValueError('Neighbor and weight arrays must be (n, k) with one row per id.')
+        self.ids = np.asarray(ids)
+        self.neighbors = neighbors
+        self.weights = weights
+        self.k = neighbors.shape[1]
+
+
+    def view(self, k):
+        """
+        Get the k nearest neighbors of every node without copying.
+        :param int k: number of neighbors per node, at most the k the table was built with.
+        :return tuple: (neighbors, weights) views of shape (n, k).
+        """
+        if not 0 < k <= self.k:
+            raise ValueError('The table holds graphs for k in 1..%s, not %s.' % (self.k, k))
+        return self.neighbors[:, :k], self.weights[:, :k]
+
+
+    def to_graph(self, k):
+        """
+        Export the k nearest neighbor graph as a Graph.
+        :param int k: number of neighbors per node.
+        """
+        neighbors, weights = self.view(k)
+        g = Graph()
+        g.add_vertices(self.ids.tolist())
+        g.add_edge_arrays(np.repeat(self.ids, k), self.ids[neighbors].ravel(), weights.ravel())
+        return g
+
+
+    def save(self, location):
+        """
+        Saves the whole family to a single numpy archive.
+        :param path location: location to save to.
+        """
+        np.savez(location, ids=self.ids, neighbors=self.neighbors, weights=self.weights)
+
+
+    @staticmethod
+    def load(location):
+        """
+        Load the family from a numpy archive.
+        :param path location: location to read from.
+        """
+        if not isfile(location):
+            raise FileNotFoundError('The location specified does not exist: %s' % location)
+        with np.load(location) as data:
+            return KNNTable(data['ids'], data['neighbors'], data['weights'])
+
+
 class GraphDriver():
     """
     Quick testing suite to validate the graph.
@@ -1,14 +1,14 @@
 #! /bin/usr/python3.6
 
 from lxml import etree
-from os import listdir, path
+from os import listdir, path, mkdir
 from os.path import isfile, isdir, join
 from util import timed
 from database import Database
 from multiprocessing import Pool
-from graph import Graph
+from graph import KNNTable
+from sparse_graph import SparseGraph
 from distance import Similarity
-import numpy as np
 
 ################################################################
 ####                    GENERIC LOADER                      ####
@@ -233,39 +233,28 @@ class Loader():
 
     @staticmethod
     @timed
-    def make_graphs(db, k=10):
+    def make_graphs(db, k=10, folder='graph'):
+        """
+        Builds the sorted k nearest neighbor lists once and saves them, so that the graph for any
+            smaller k can be exported later with KNNTable.load(...).to_graph(k). Only the graph
+            for k itself is built and saved here.
+        :param Database db: database with the visual descriptors.
+        :param int k: number of similar images to keep edges to.
+        :param path folder: folder to save the table and graph in.
+        """
         all_photos = db.get_vis_table()
-        similarity = Similarity.cosine_similarity(all_photos, all_photos)
-        assert(similarity.shape[0] == similarity.shape[1])
-        # set similarity diagonal to 0 so we don't have to deal with self similarity.
-        length = similarity.shape[0]
-        similarity.values[[np.arange(length)]*2]=0
-
-        # get similar k only.
-        edge_dict = {}
-        for i in range(length):
-            row = similarity.iloc[i]
-            edge_dict[row.name] = {}
-            sorted_row = row.sort_values(ascending=False)
-            keys = sorted_row.iloc[:k].index
-            for key in keys:
-                edge_dict[row.name][key] = sorted_row[key]
-        
+        # only the k most similar photos per row are kept, the full matrix is never built.
+        table = KNNTable(*Similarity.cosine_top_k(all_photos, k))
 
-        for nearest in range(k, 0, -1):
-
-            # get rid of smallest item.
-            print('Working on graph %s.' % nearest)
-            for key in edge_dict:
-                min_key = min(edge_dict[key], key=edge_dict[key].get)
-                edge_dict[key].pop(min_key)
-
-            print('\tSimilarity graph for %s created.' % nearest)
-            
-            location = join('graph', 'graph' + str(nearest))
-            g = Graph()
-            g.add_edge_dict(edge_dict)
-            g.display(filename=location+'.png')
-            g.save(location=location)
-        
-        return g
\ No newline at end of file
+        if not isdir(folder):
+            mkdir(folder)
+        table.save(join(folder, 'knn.npz'))
+        print('Similarity lists for k = 1..%s saved.' % k)
+
+        location = join(folder, 'graph' + str(k))
+        g = table.to_graph(k)
+        g.save(location=location)
+        # memory mappable snapshot for loading with --graph <folder>/graph<k>_csr
+        SparseGraph.from_knn_table(table, k).save(location + '_csr')
+        print('\tSimilarity graph for %s created.' % k)
+        return g
@@ -1,14 +1,15 @@
 #! /bin/usr/python3.6
 from loader import Loader
 from distance import Similarity
-from graph import Graph
-from os.path import abspath, isdir, isfile
+from graph import Graph, KNNTable
+from sparse_graph import SparseGraph
+from os.path import abspath, dirname, isdir, isfile, join
 import argparse
 from util import timed, show_images
 import numpy as np
-import numpy.linalg as la
 import scipy.cluster.vq as vq
-from scipy.sparse import csc_matrix
+from decompose import Decompose
+from pagerank import PageRank, PPRIndex
 from task5 import LSH
 from task6 import KNN
 
@@ -18,6 +19,10 @@ class Interface():
     def __init__(self):
         self.__database__ = None
         self.__graph__ = None
+        self.__graph_file__ = None
+        self.__pagerank__ = None
+        self.__ppr_cache__ = None
+        self.__lsh__ = LSH()
         self.__valid_types__ = ['photo', 'user', 'poi']
         self.__vis_models__ = ['CM', 'CM3x3', 'CN', 'CN3x3',
                                'CSD', 'GLRLM', 'GLRLM3x3', 'HOG', 'LBP', 'LBP3x3']
@@ -40,8 +45,17 @@ class Interface():
         parser.add_argument('--imgs', type=str, nargs='+', metavar='imageId')
         parser.add_argument('--load', type=str, metavar='filepath')
         parser.add_argument('--graph', type=str, metavar='filename')
+        parser.add_argument('--backend', type=str, choices=['igraph', 'sparse'], default='igraph')
         parser.add_argument('--layers', type=int, metavar='L')
         parser.add_argument('--hashes', type=int, metavar='k')
+        parser.add_argument('--epsilon', type=float, metavar='e')
+        parser.add_argument('--walks', type=int, metavar='#')
+        parser.add_argument('--probes', type=int, metavar='#', default=0)
+        parser.add_argument('--simhash', type=int, metavar='#', default=0)
+        parser.add_argument('--bits', type=int, metavar='#', default=256)
+        parser.add_argument('--file', type=str, metavar='filename')
+        parser.add_argument('--csv', type=str, metavar='filename', default='task5.csv')
+        parser.add_argument('--exact', action='store_true')
         # parser.add_argument('--cluster', type=int, metavar='c')
         parser.add_argument('--vectors', type=str)  # Assuming this is a file locaiton
         while True:
@@ -118,20 +132,64 @@ class Interface():
 
     def graph(self, args):
         """
-        Command:\t--graph <filepath>
-        Description:\tLoads the graph from the binary (pickle file) specified.
+        Command:\t--graph <filepath> [--k #] [--backend igraph|sparse]
+        Description:\tLoads the graph from the binary (pickle file) or snapshot directory specified,
+        \tor the graph for any k up to the one task 1 was run with from graph/knn.npz.
         Arguments:
-        \t<filepath> a valid file path in the system.
+        \t<filepath> a valid file path or snapshot directory in the system.
+        \t<k> with knn.npz, the number of similar images to keep edges to. All of them by default.
+        \t<backend> igraph (default) or sparse, a CSR matrix backed graph for the analytics tasks.
         """
         f = abspath(args.graph)
 
-        if not isfile(f):
+        if not isfile(f) and not isdir(f):
             print("[ERROR] The provided path was not a valid file.")
             return
 
-        self.__graph__ = Graph.load(f)
+        if f.endswith('.npz'):
+            table = KNNTable.load(f)
+            k = table.k if args.k is None else int(args.k)
+            if args.backend == 'sparse':
+                self.__graph__ = SparseGraph.from_knn_table(table, k)
+            else:
+                self.__graph__ = table.to_graph(k)
+            # name it like the graph task 1 would have saved, for the files cached next to it.
+            f = join(dirname(f), 'graph' + str(k))
+        elif args.backend == 'sparse':
+            self.__graph__ = SparseGraph.load(f)
+        else:
+            self.__graph__ = Graph.load(f)
+        self.__graph_file__ = f
         print('Graph loaded successfully.')
 
+    def __engine__(self):
+        """
+        PageRank engine and image ids for the loaded graph. Built once per graph so repeated
+            queries don't pay for the transition matrix again.
+        """
+        if self.__pagerank__ is None or not self.__pagerank__[0] is self.__graph__:
+            G, images = self.__graph__.get_adjacency(sparse=True)
+            self.__pagerank__ = (self.__graph__, PageRank(G, damping=0.86), images)
+        return self.__pagerank__[1], self.__pagerank__[2]
+
+    def __ppr__(self, engine):
+        """
+        Precomputed PPR index of the loaded graph, if the offline job saved one next to it and it
+            was built from the same graph as the engine.
+        """
+        if self.__graph_file__ is None:
+            return None
+        location = self.__graph_file__ + '_ppr.npz'
+        if self.__ppr_cache__ is None or self.__ppr_cache__[0] != location or not self.__ppr_cache__[1] is engine:
+            index = PPRIndex.load(location) if isfile(location) else None
+            if index is not None and not index.matches(engine):
+                index = None
+            if index is None and isfile(location):
+                print('%s was not built from the loaded graph, solving instead. Rebuild it with:' % location)
+                print('\tpython pagerank.py %s' % self.__graph_file__)
+            self.__ppr_cache__ = (location, engine, index)
+        return self.__ppr_cache__[2]
+
     @timed
     def task1(self, args):
         if self.__graph__ == None:
@@ -139,6 +197,9 @@ class Interface():
                 raise ValueError('Parameter K must be defined for task 1.')
             k = int(args.k)
             self.__graph__ = Loader.make_graphs(self.__database__, k)
+            self.__graph_file__ = abspath(join('graph', 'graph' + str(k)))
+            if args.backend == 'sparse':
+                self.__graph__ = SparseGraph.from_graph(self.__graph__)
         # visualize graph.
         self.__graph__.display()
 
@@ -146,27 +207,27 @@ class Interface():
         if args.k == None:
             raise ValueError('K must be defined for task 2.')
         c = int(args.k)
-        # alg = args.alg
+        # --alg normalized uses the normalized Laplacian.
+        normalized = args.alg == 'normalized'
 
         # YOUR CODE HERE.
         clusters = {}
         clusters1 = {}
-        images = self.__graph__.get_images()
         list_of_clusters = []
         list_of_clusters1 = []
         lengOfA = 0
         lengOfB = 0
         lengOfClusters = {}
-        A = self.__graph__.get_adjacency()
-        D = np.diag(np.ravel(np.sum(A, axis=1)))
-        L = D - A
-        l, U = la.eigh(L)
+        A, images = self.__graph__.get_adjacency(sparse=True)
+        # only the smallest c + 1 eigenpairs are used, cached next to the graph for other c.
+        cache = None if self.__graph_file__ is None else self.__graph_file__ + '_spectral.npz'
+        l, U = Decompose.spectral_embedding(A, max(c + 1, 2), normalized=normalized, cache=cache)
         f = U[:, 1]
         labels = np.ravel(np.sign(f))
         # Clustering function
-        for image in images:
+        for i, image in enumerate(images):
 
-            if (labels[images.index(image)] == -1):
+            if (labels[i] == -1):
                 cluster = 'A'
                 clusters[image] = cluster
                 lengOfA += 1
@@ -208,128 +269,85 @@ class Interface():
         k = int(args.k)
 
         # YOUR CODE HERE.
-        G = self.__graph__.get_adjacency()
-        images = self.__graph__.get_images()
-        n = G.shape[0]
-        s = 0.86
-        maxerr = 0.001
-
-        # transform G into markov matrix A
-        A = csc_matrix(G, dtype=np.float)
-        rsums = np.array(A.sum(1))[:, 0]
-        ri, ci = A.nonzero()
-        A.data /= rsums[ri]
-
-        # bool array of sink states
-        sink = rsums == 0
-
-        # Compute pagerank r until we converge
-        ro, r = np.zeros(n), np.ones(n)
-        while np.sum(np.abs(r - ro)) > maxerr:
-            ro = r.copy()
-            # calculate each pagerank at a time
-            for i in range(0, n):
-                # in-links of state i
-                Ai = np.array(A[:, i].todense())[:, 0]
-                # account for sink states
-                Di = sink / float(n)
-                # account for teleportation to state i
-                Ei = np.ones(n) / float(n)
-
-                r[i] = ro.dot(Ai * s + Di * s + Ei * (1 - s))
-
-        weights = r / float(sum(r))
-        orderedWeights = np.argsort(weights)
-        ReorderedWeights = np.flipud(orderedWeights)
-        # m = max(weights)
-        # ind = np.argmax(weights)
-        listOfImages = list()
-        for xx in range(k):
-            listOfImages.append(images[ReorderedWeights[xx]])
-        # weightDict = {}
-        # for xx in range(len(weights)):
-        #     weightDict[xx] = weights[xx]
+        engine, images = self.__engine__()
+        if args.walks:
+            result = engine.monte_carlo(walks=int(args.walks))
+        else:
+            result = engine.solve(tol=1e-8)
+        print(result)
+
+        listOfImages = [images[i] for i in result.top(k)]
         print(listOfImages)
-        pass
 
     @timed
     def task4(self, args):
+        """
+        Use as:
+        -task 4 --k # --imgs image1 image2 image3 [--epsilon e | --walks #]
+        With --epsilon, runs a local push PPR that only explores nodes with residual above e.
+        With --walks, estimates the PPR from that many random walks.
+        Otherwise uses the precomputed index <graph>_ppr.npz when it exists (see pagerank.py).
+        """
         if args.k == None or args.imgs == None:
             raise ValueError('K and Imgs must be defined for task 4.')
         k = int(args.k)
         imgs = list(args.imgs)
         # 6 2976167 83 38391649 299 135049429
         # YOUR CODE HERE.
-        G = self.__graph__.get_adjacency()
-        images = self.__graph__.get_images()
+        engine, images = self.__engine__()
         indexes = list()
         for x in imgs:
             indexes.append(images.index(x))
-        n = G.shape[0]
-        s = 0.86
-        maxerr = 0.1
-
-        # transform G into markov matrix A
-        A = csc_matrix(G, dtype=np.float)
-        rsums = np.array(A.sum(1))[:, 0]
-        ri, ci = A.nonzero()
-        A.data /= rsums[ri]
-
-        # bool array of sink states
-        sink = rsums == 0
-
-        Ei = np.zeros(n)
-        for ii in indexes:
-            Ei[ii] = 1 / len(imgs)
-        # Compute pagerank r until we converge
-        ro, r = np.zeros(n), np.ones(n)
-        # while np.sum(np.abs(r - ro)) > maxerr:
-        for _ in range(100):
-
-            if np.sum(np.abs(r - ro)) <= maxerr:
-                break
-
-            ro = r.copy()
-            # calculate each pagerank at a time
-            for i in range(0, n):
-                # in-links of state i
-                Ai = np.array(A[:, i].todense())[:, 0]
-                # account for sink states
-                # Di = sink / float(n)
-                # account for teleportation to state i
-
-                r[i] = ro.dot(Ai * s + Ei * (1 - s))
-
-        weights = r / float(sum(r))
-        orderedWeights = np.argsort(weights)
-        ReorderedWeights = np.flipud(orderedWeights)
-        # m = max(weights)
-        # ind = np.argmax(weights)
-        listOfImages = list()
-        for xx in range(k):
-            listOfImages.append(images[ReorderedWeights[xx]])
+
+        if args.epsilon:
+            result = engine.push(indexes, epsilon=float(args.epsilon))
+        elif args.walks:
+            result = engine.monte_carlo(engine.teleport(indexes), walks=int(args.walks))
+        elif not self.__ppr__(engine) is None:
+            result = self.__ppr__(engine).query(indexes)
+        else:
+            result = engine.solve(engine.teleport(indexes), tol=1e-8, max_iter=100)
+        print(result)
+
+        listOfImages = [images[i] for i in result.top(k)]
         print(listOfImages)
-        pass
 
     def task5(self, args):
         """
         Use as:
-        -task 5 --layers # --hashes # --k # --imgs #
+        -task 5 --layers # --hashes # --k # --imgs # [--probes #]
+        -task 5 --simhash # [--bits #] --k # --imgs #
+        With --probes, also visits that many neighboring buckets (multi-probe LSH).
+        With --simhash, takes that many candidates by Hamming distance between packed random
+        hyperplane signatures of --bits bits instead of the LSH buckets.
+        With several --imgs, or --file naming a file of image ids, runs every query as one batch
+        and writes the results to --csv (task5.csv by default).
+        -task 5 --exact --k # --imgs #
+        With --exact, finds the exact L3 nearest images over all the columns instead, using a pivot
+        index to skip the images that cannot be among them.
         """
-        if args.layers == None or args.hashes == None or \
-                args.k == None or args.imgs == None:
+        if args.file:
+            with open(args.file) as f:
+                args.imgs = (args.imgs or []) + f.read().replace(',', ' ').split()
+        if args.k == None or not args.imgs or \
+                (not args.simhash and not args.exact and (args.layers == None or args.hashes == None)):
             raise ValueError('Layers, Hashes, Vectors, K, and IMG must all be defined for task 5.')
 
-        layers = int(args.layers)
-        hashes = int(args.hashes)
+        layers = int(args.layers) if args.layers else 0
+        hashes = int(args.hashes) if args.hashes else 0
         t = int(args.k)
         imageId = args.imgs
         if args.vectors:
             vectors = str(args.vectors)
 
         # YOUR CODE HERE
-        lsh = LSH()
-        lsh.main(layers, hashes, imageId, vectors=(), t=t, database=self.__database__)
+        if len(imageId) > 1 or args.file:
+            self.__lsh__.batch(layers, hashes, imageId, t, self.__database__, probes=int(args.probes),
+                               simhash=int(args.simhash), bits=int(args.bits), output=args.csv, exact=args.exact)
+            return
+        self.__lsh__.main(layers, hashes, imageId, vectors=(), t=t, database=self.__database__,
+                          probes=int(args.probes), simhash=int(args.simhash), bits=int(args.bits),
+                          exact=args.exact)
 
     def task6(self, args):
         if args.alg == None:
@@ -357,8 +375,7 @@ class Interface():
             print("result: " + str(result))
 
         elif alg == "ppr":
-            G = self.__graph__.get_adjacency()
-            images = self.__graph__.get_images()
+            engine, images = self.__engine__()
             indexes = list()
 
             imageIDs = ['3298433827', '299114458', '948633075', '4815295122', '5898734700', '4027646409', '1806444675',
@@ -368,46 +385,27 @@ class Interface():
 
             for x in imageIDs:
                 indexes.append(images.index(x))
-            n = G.shape[0]
-            s = 0.86
-            maxerr = 0.1
-
-            # transform G into markov matrix A
-            A = csc_matrix(G, dtype=np.float)
-            rsums = np.array(A.sum(1))[:, 0]
-            ri, ci = A.nonzero()
-            A.data /= rsums[ri]
-
-            # bool array of sink states
-            sink = rsums == 0
-
-            Ei = np.zeros(n)
-            for ii in indexes:
-                Ei[ii] = 1 / len(imageIDs)
-            # Compute pagerank r until we converge
-            ro, r = np.zeros(n), np.ones(n)
-            # while np.sum(np.abs(r - ro)) > maxerr:
-            for _ in range(100):
-
-                if np.sum(np.abs(r - ro)) <= maxerr:
-                    break
-
-                ro = r.copy()
-                # calculate each pagerank at a time
-                for i in range(0, n):
-                    # in-links of state i
-                    Ai = np.array(A[:, i].todense())[:, 0]
-                    # account for sink states
-                    # Di = sink / float(n)
-                    # account for teleportation to state i
-
-                    r[i] = ro.dot(Ai * s + Ei * (1 - s))
-
-            weights = r / float(sum(r))
-            orderedWeights = np.argsort(weights)
-            ReorderedWeights = np.flipud(orderedWeights)
-
-            # gotta do something now
+
+            # one PPR vector per label, all solved together against a (n x labels) teleport matrix.
+            label_names = sorted(set(labels))
+            groups = [[i for i, label in zip(indexes, labels) if label == name] for name in label_names]
+            if args.walks:
+                result = engine.monte_carlo(engine.teleports(groups), walks=int(args.walks))
+            else:
+                result = engine.solve(engine.teleports(groups), tol=1e-8, max_iter=100)
+            print(result)
+
+            # every image takes the label whose PPR vector scores it highest. Images no label's
+            #   seeds reach score 0 everywhere and are reported as unassigned instead.
+            assigned = np.asarray(label_names)[np.argmax(result.scores, axis=1)]
+            reached = result.scores.max(axis=1) > 0
+            unlabelled = np.ones(len(images), dtype=bool)
+            unlabelled[indexes] = False
+            for name in label_names:
+                members = [images[i] for i in np.flatnonzero(unlabelled & reached & (assigned == name))]
+                print('%s (%s images): %s' % (name, len(members), members))
+            members = [images[i] for i in np.flatnonzero(unlabelled & ~reached)]
+            print('unassigned, not reachable from any label (%s images): %s' % (len(members), members))
 
     def quit(self, *args):
         """
@@ -1,53 +1,250 @@
 #! /bin/usr/python3.6
 
 from distance import Distance, Similarity, Scoring
-from heapq import heappush, merge, nsmallest
 from util import timed
 from numpy.linalg import norm
 from numpy import dot
 import numpy as np
-from multiprocessing import Pool
-from math import ceil
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+import atexit
 from decompose import Decompose
 from sklearn.metrics.pairwise import cosine_similarity
 from numpy import union1d
 from database import Database
 from sklearn.neighbors import KNeighborsClassifier
-import pandas as pd
 
 
-# A class is implemented for this tuple to ensure that
-#   the heapq can compare when appending.
-class DistanceMeasure():
-    def __init__(self, an_id, distance):
-        self.id = an_id
-        self.dist = distance
+class Nearest():
+    """
+    Result of a k nearest search: the ids of the nearest rows and their distances (or scores), \
+        best first, as two arrays. Iterating gives (id, distance) pairs.
+    """
+    def __init__(self, ids, distances):
+        self.ids = np.asarray(ids)
+        self.distances = np.asarray(distances)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return zip(self.ids.tolist(), self.distances.tolist())
 
-    def __lt__(self, other):
-        return self.dist < other.dist
-    
     def __str__(self):
-        return "( id = " + str(self.id) + ", distance = " + str(self.dist) + ")"
-    
+        return "\n".join("( id = " + str(an_id) + ", distance = " + str(dist) + ")" for an_id, dist in self)
+
     def __repr__(self):
         return self.__str__()
 
 
+class KNNPool():
+    """
+    Long lived worker processes for parallel kNN over one feature matrix held in shared memory \
+        (Database.share_vis_matrix). Every worker attaches to it when it starts, so a query only \
+        sends the vector and a row range to each worker and gets back the k nearest rows of that \
+        range. Start one per session and close it when done. Needs Python 3.8.
+    """
+    # shared memory and matrix view of the pool this worker process belongs to.
+    shared = None
+
+    def __init__(self, ids, matrix, name, processes=None):
+        """
+        :param ids: id of every row of the matrix.
+        :param numpy.ndarray matrix: (n, d) feature matrix, a view of the shared memory block.
+        :param str name: name of the shared memory block.
+        :param int processes: number of workers, one per core by default.
+        """
+        self.ids = np.asarray(ids)
+        self.matrix = matrix
+        self.shape = matrix.shape
+        self.processes = processes or cpu_count()
+        self.pool = Pool(self.processes, initializer=KNNPool.attach, initargs=(name, self.shape))
+        atexit.register(self.close)
+
+    @staticmethod
+    def attach(name, shape):
+        """
+        Worker initializer, maps the shared matrix into the worker.
+        """
+        from multiprocessing.shared_memory import SharedMemory
+        memory = SharedMemory(name=name)
+        KNNPool.shared = (memory, np.ndarray(shape, dtype=np.float64, buffer=memory.buf))
+
+    @staticmethod
+    def worker(k, vector, columns, start, stop):
+        """
+        k nearest rows between start and stop of the shared matrix, by row position.
+        """
+        table = KNNPool.shared[1][start:stop]
+        if columns is not None:
+            table = table[:, columns]
+        nearest = Neighbor.top_k(k, np.arange(start, stop), Distance.l_p_distance(3, vector, table))
+        return nearest.ids, nearest.distances
+
+    def query(self, k, vector, columns=None):
+        """
+        k nearest rows of the matrix to the vector.
+        :param numpy.ndarray vector: query vector, already cut to the columns if they are given.
+        :param numpy.ndarray columns: only compare these columns.
+        :return Nearest: ids and distances of the k nearest rows.
+        """
+        bounds = np.linspace(0, self.shape[0], self.processes + 1).astype(int)
+        args = [(k, vector, columns, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        out = self.pool.starmap(KNNPool.worker, args)
+        nearest = Neighbor.top_k(k, np.concatenate([rows for rows, _ in out]),
+                                 np.concatenate([distances for _, distances in out]))
+        return Nearest(self.ids[nearest.ids], nearest.distances)
+
+    def close(self):
+        """
+        Stops the workers. The shared memory belongs to the database.
+        """
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        atexit.unregister(self.close)
+
+
+class PivotIndex():
+    """
+    Exact nearest rows under an L_p metric (p >= 1) with pivot pruning. The distance from every \
+        row to a few pivot rows is computed once. For a query q, the triangle inequality gives the \
+        lower bound max over pivots of |d(q, pivot) - d(row, pivot)| for every row, so rows are \
+        compared in increasing bound order and the search stops once the next bound is above the \
+        k-th best distance found. Unlike knn_visual, all the columns are compared, since the \
+        distance over the columns of one query is not a metric the pivots can bound.
+    """
+
+    def __init__(self, ids, matrix, pivots=32, p=3, seed=None):
+        """
+        :param ids: id of every row of the matrix.
+        :param numpy.ndarray matrix: (n, d) feature matrix.
+        :param int pivots: number of pivot rows.
+        :param int seed: random seed for the first pivot.
+        """
+        self.ids = np.asarray(ids)
+        self.matrix = matrix
+        self.p = p
+        self.seed = seed
+        self.num_pivots = min(pivots, len(matrix))
+        self.pivots = None
+        self.distances = None
+        # number of full distances computed by the last query.
+        self.evaluated = 0
+
+
+    @timed
+    def build(self):
+        """
+        Picks the pivots by farthest first traversal, each one the row farthest from the pivots \
+            already picked, and keeps the (n, pivots) distances from every row to them.
+        """
+        n = len(self.matrix)
+        rng = np.random.RandomState(self.seed)
+        self.pivots = np.empty(self.num_pivots, dtype=np.int64)
+        self.distances = np.empty((n, self.num_pivots))
+        nearest = np.full(n, np.inf)
+        pivot = rng.randint(n) if n else 0
+        for i in range(self.num_pivots):
+            self.pivots[i] = pivot
+            self.distances[:, i] = Distance.l_p_distance(self.p, self.matrix[pivot], self.matrix)
+            np.minimum(nearest, self.distances[:, i], out=nearest)
+            pivot = np.argmax(nearest)
+        return self
+
+
+    def query(self, k, vector, block_size=256):
+        """
+        The k rows nearest to vector, exactly.
+        :param numpy.ndarray vector: (d,) query vector.
+        :param int block_size: number of rows compared at once, in bound order.
+        :return Nearest: ids and distances of the k nearest rows.
+        """
+        to_pivots = Distance.l_p_distance(self.p, vector, self.matrix[self.pivots])
+        bounds = np.abs(self.distances - to_pivots).max(axis=1)
+        order = np.argsort(bounds, kind='mergesort')
+
+        best = Nearest(np.array([], dtype=np.int64), np.array([]))
+        self.evaluated = 0
+        for start in range(0, len(order), block_size):
+            block = order[start:start + block_size]
+            if len(best) == k:
+                kth = best.distances[-1]
+                if bounds[block[0]] > kth:
+                    break
+                block = block[bounds[block] <= kth]
+            distances = Distance.l_p_distance(self.p, vector, self.matrix[block])
+            self.evaluated += len(block)
+            best = Neighbor.top_k(k, np.concatenate((best.ids, block)),
+                                  np.concatenate((best.distances, distances)))
+        return Nearest(self.ids[best.ids], best.distances)
+
+
 class Neighbor():    
 
+    # session worker pool over the visual matrix, see Neighbor.get_pool.
+    pool = None
+    # session pivot index over the visual matrix, see Neighbor.get_pivot_index.
+    pivot_index = None
+
     @staticmethod
-    def knn_worker(vector, table):
+    def top_k(k, ids, distances, largest=False):
+        """
+        Selects the k smallest distances (largest scores if largest is set) with argpartition and \
+        sorts only those k.
+        :param ids: id of every row.
+        :param numpy.ndarray distances: distance of every row.
+        :return Nearest: the k best rows, best first.
+        """
+        distances = np.asarray(distances)
+        order = -distances if largest else distances
+        if k < len(distances):
+            best = np.argpartition(order, k - 1)[:k]
+        else:
+            best = np.arange(len(distances))
+        best = best[np.argsort(order[best], kind='mergesort')]
+        return Nearest(np.asarray(ids)[best], distances[best])
+
+
+    @staticmethod
+    def get_pool(database, processes=None):
+        """
+        Worker pool over the visual matrix of the database, started on the first call and kept \
+            for the session. Restarted when the visual data or the number of processes changes.
+        """
+        ids, matrix, name = database.share_vis_matrix()
+        pool = Neighbor.pool
+        if pool is None or pool.matrix is not matrix or (processes and pool.processes != processes):
+            if pool is not None:
+                pool.close()
+            Neighbor.pool = KNNPool(ids, matrix, name, processes)
+        return Neighbor.pool
+
+
+    @staticmethod
+    def get_pivot_index(database, pivots=32):
+        """
+        L3 pivot index over the visual matrix of the database, built on the first call and kept \
+            for the session. Rebuilt when the visual data or the number of pivots changes.
+        """
+        ids, matrix = database.get_vis_matrix()
+        index = Neighbor.pivot_index
+        if index is None or index.matrix is not matrix or index.num_pivots != min(pivots, len(matrix)):
+            Neighbor.pivot_index = PivotIndex(ids, matrix, pivots, p=3, seed=0).build()
+        return Neighbor.pivot_index
+
+
+    @staticmethod
+    def knn_worker(k, vector, table):
         """
         Worker for each process of the distance calculation. Runs the actual distance measure \
-        and aggregates the results into heap for fast merge sort with other processes.
+        and keeps the k nearest rows of its part of the table for the merge with other processes.
         """
 
-        dist_table = Distance.l_p_distance(3, vector, table)
-        distances = list()
-        for index in dist_table.index:
-            heappush(distances, DistanceMeasure(index, dist_table[index]))
-        
-        return distances
+        distances = Distance.l_p_distance(3, vector, table)
+        return Neighbor.top_k(k, table.index, np.asarray(distances))
 
 
 
@@ -57,28 +254,33 @@ class Neighbor():
         Given a vector (pandas Series) and a table (pandas Dataframe) finds the distance \
         from vector to each row of the table. Returns the indexes of the 'k' rows in table \
         with the shortest distance to vector. Will parallellize the nearest neighbor \
-        calculation across p processes if processes is set to a value other than 1.
+        calculation across p threads if processes is set to a value other than 1.
+
+        The tables here are built per call (textual tables, visual tables of one location or \
+        model), so they are not in the shared memory of the session pool. Threads share the \
+        table instead of pickling a slice of it to new processes, and numpy releases the GIL \
+        for the distances.
         """
 
         if processes > 1:
-            rows = table.shape[0]
-            size = ceil(rows / processes)
-
-            args = []
-            for i in range(processes):
-                subtable = table.iloc[i * size : (i + 1) * size]
-                args.append((vector, subtable))
-            
-            p = Pool(processes)
-            print("Starting threads!")
-            out = p.starmap(Neighbor.knn_worker, args)
-            dists = merge(*out)
-        
-        else:
-            dists = Neighbor.knn_worker(vector, table)
+            matrix = np.asarray(table.values, dtype=np.float64)
+            vector = np.asarray(vector.reindex(table.columns), dtype=np.float64)
+            bounds = np.linspace(0, matrix.shape[0], processes + 1).astype(int)
+
+            def part(start, stop):
+                return Neighbor.top_k(k, np.arange(start, stop),
+                                      Distance.l_p_distance(3, vector, matrix[start:stop]))
+
+            pool = ThreadPool(processes)
+            out = pool.starmap(part, zip(bounds[:-1], bounds[1:]))
+            pool.close()
+            pool.join()
+            # each thread returns at most k rows, so the merge only looks at k * processes.
+            nearest = Neighbor.top_k(k, np.concatenate([part.ids for part in out]),
+                                     np.concatenate([part.distances for part in out]))
+            return Nearest(np.asarray(table.index)[nearest.ids], nearest.distances)
         
-        nearest = nsmallest(k, dists)
-        return nearest
+        return Neighbor.knn_worker(k, vector, table)
 
 
 
@@ -113,11 +315,21 @@ class Neighbor():
         KNN Specific method for visual vectors. Retrieves the visual description table based \
             on the locationid and model. If locationid is None, the table is for all locations. \
             If model is None, the table is for all visual models. If both are none, the table is \
-            for all locations and visual models. Calls KNN on vector and table derived.
+            for all locations and visual models. Calls KNN on vector and table derived. \
+            With several processes over the whole table, the session worker pool is used.
         
         The KNN cuts the vector and table to only the columns present in the vector for \
             efficiency and because the professor seems to suggest this is acceptable.
         """
+        if processes > 1 and locationid is None and model is None:
+            pool = Neighbor.get_pool(database, processes)
+            row = np.flatnonzero(pool.ids == photoid)
+            if not len(row):
+                raise ValueError('The image %s could not be found' % photoid)
+            vector = pool.matrix[row[0]]
+            vec_indexes = vector.nonzero()[0]
+            return pool.query(k, vector[vec_indexes], vec_indexes)
+
         table = database.get_vis_table(locationid, model)
         vector = table.loc[photoid]
         vec_indexes = vector.nonzero()[0]
@@ -125,38 +337,82 @@ class Neighbor():
         table = table.iloc[:, vec_indexes]
 
         return Neighbor.knn(k, vector, table, processes)
+
+
+    @staticmethod
+    @timed
+    def knn_visual_exact(k, photoid, database, pivots=32):
+        """
+        Exact L3 KNN for visual vectors over all the columns and all locations and models, using \
+            the session pivot index to skip the rows that cannot be among the k nearest.
+        """
+        index = Neighbor.get_pivot_index(database, pivots)
+        row = np.flatnonzero(index.ids == photoid)
+        if not len(row):
+            raise ValueError('The image %s could not be found' % photoid)
+        nearest = index.query(k, index.matrix[row[0]])
+        print("Number of images compared: " + str(index.evaluated))
+        return nearest
     
     @staticmethod
     @timed
-    def knn_visual_LSH(k, this_image, database, those_images, processes=1):
+    def knn_visual_LSH(k, row, database, candidates):
         """
-        KNN Specific method for visual vectors. Retrieves the visual description table based \
-            on the imageIds passed. If locationid is None, the table is for all locations. \
-            If model is None, the table is for all visual models. If both are none, the table is \
-            for all locations and visual models. Calls KNN on vector and table derived.
+        KNN Specific method for visual vectors, used to rerank the candidates found by LSH. Slices \
+            the candidate rows out of the visual matrix (Database.get_vis_matrix) and finds their \
+            distances to the query in one call, so the cost depends on the number of candidates \
+            and not on the size of the dataset.
 
         The KNN cuts the vector and table to only the columns present in the vector for \
             efficiency and because the professor seems to suggest this is acceptable.
+
+        :param int row: row position of the query image in the visual matrix.
+        :param numpy.ndarray candidates: row positions of the candidate images.
         """
-        # edit table to get only desired imageIds(received from LSH bucketing) to be included
-        num_comparisons = len(those_images)
+        ids, matrix = database.get_vis_matrix()
+        candidates = np.asarray(candidates, dtype=np.intp)
+        num_comparisons = len(candidates)
+
+        vector = matrix[row]
+        vec_indexes = vector.nonzero()[0]
+        table = matrix[candidates][:, vec_indexes]
 
-        whole_table = pd.DataFrame(database.get_vis_table())
-        whole_table = whole_table.T
-        whole_table = whole_table.to_dict('list')
+        distances = Distance.l_p_distance(3, vector[vec_indexes], table)
+        return Neighbor.top_k(k, ids[candidates], distances), num_comparisons
 
-        table = {}
-        for image in those_images:
-            table[image] = whole_table[image]
+    @staticmethod
+    @timed
+    def knn_visual_batch(k, rows, database, candidates, block_size=2 ** 22):
+        """
+        Batch version of knn_visual_LSH. The (query, candidate) pairs of as many queries as fit in \
+            block_size distance terms are gathered into one array and their distances found in one \
+            call, and the k nearest of every query are taken with a single sort of the block.
 
-        table = pd.DataFrame.from_dict(table, orient='index')
-        # print(table)
+        Columns outside the nonzero ones of each query are masked out, the same cut as knn_visual_LSH.
 
-        vector = table.loc[this_image]
-        print(vector)
-        vec_indexes = vector.nonzero()[0]
-        vector = vector[vec_indexes]
+        :param numpy.ndarray rows: row positions of the query images in the visual matrix.
+        :param list candidates: row positions of the candidate images of every query.
+        :return list: Nearest images of every query.
+        """
+        ids, matrix = database.get_vis_matrix()
+        sizes = np.array([len(c) for c in candidates], dtype=np.int64)
+        # first query of every block.
+        bounds = [0]
+        while bounds[-1] < len(rows):
+            ends = np.cumsum(sizes[bounds[-1]:]) * matrix.shape[1]
+            bounds.append(bounds[-1] + max(1, int(np.searchsorted(ends, block_size, side='right'))))
 
-        table = table.iloc[:, vec_indexes]
+        results = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            flat = np.concatenate(candidates[start:stop]).astype(np.intp)
+            owner = np.repeat(np.arange(stop - start), sizes[start:stop])
+            queries = matrix[np.asarray(rows)[start:stop]]
+            distances = Distance.l_p_paired(3, queries, matrix, owner, flat, mask=queries != 0)
 
-        return Neighbor.knn(k, vector, table, processes), num_comparisons
+            # sort by query then distance, the first k of every query are its nearest.
+            order = np.lexsort((distances, owner))
+            offsets = np.concatenate(([0], np.cumsum(sizes[start:stop])))
+            for i in range(stop - start):
+                nearest = order[offsets[i]:offsets[i] + min(k, sizes[start + i])]
+                results.append(Nearest(ids[flat[nearest]], distances[nearest]))
+        return results
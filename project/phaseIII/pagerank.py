@@ -0,0 +1,385 @@
+#! /bin/usr/python3.6
+from time import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from math import ceil
+from os.path import isfile
+from sys import argv
+from util import timed
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from hashlib import md5
+
+
+class PageRankResult():
+    """
+    Scores of a PageRank run along with how the run converged.
+    """
+
+    def __init__(self, scores, iterations, residuals, seconds, nodes=None):
+        """
+        :param numpy.ndarray scores: PageRank score of every node, summing to 1.
+        :param int iterations: number of sweeps (or pushes) run.
+        :param list residuals: L1 change of the scores after each sweep, or residual mass left.
+        :param float seconds: wall time of the run.
+        :param numpy.ndarray nodes: positions the scores belong to when only part of the graph was
+            scored. If None, scores covers every node.
+        """
+        self.scores = scores
+        self.iterations = iterations
+        self.residuals = residuals
+        self.seconds = seconds
+        self.nodes = nodes
+
+
+    def top(self, k):
+        """
+        Positions of the k highest scoring nodes, best first. Only the k best are sorted. For
+            single teleport runs only.
+        :param int k: number of nodes to return.
+        """
+        k = min(k, len(self.scores))
+        if k < 1:
+            return np.array([], dtype=np.int64)
+        best = np.argpartition(-self.scores, k - 1)[:k]
+        best = best[np.argsort(-self.scores[best], kind='mergesort')]
+        return best if self.nodes is None else self.nodes[best]
+
+
+    def __str__(self):
+        residual = self.residuals[-1] if self.residuals else float('nan')
+        return 'PageRank: %s iterations, residual %.3g, %.4f seconds' % \
+            (self.iterations, residual, self.seconds)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+
+class PageRank():
+    """
+    Power iteration PageRank over a sparse graph. The column stochastic transition matrix is built
+        once, so the same engine serves global and personalized runs.
+    """
+
+    def __init__(self, adjacency, damping=0.86):
+        """
+        :param scipy.sparse.csr_matrix adjacency: (n, n) adjacency, rows are edge sources. Weights
+            are used as transition preferences.
+        :param float damping: probability of following an edge instead of teleporting.
+        """
+        A = csr_matrix(adjacency, dtype=np.float64)
+        self.n = A.shape[0]
+        self.damping = damping
+
+        out = np.ravel(A.sum(axis=1))
+        # sinks have no out edges, their mass is sent back through the teleport vector instead.
+        self.sink = out == 0
+        inv = np.zeros(self.n)
+        inv[~self.sink] = 1 / out[~self.sink]
+        # row stochastic: forward[i, j] is the probability of stepping from i to j.
+        self.forward = diags(inv).dot(A).tocsr()
+        self.degree = np.diff(self.forward.indptr)
+        # column stochastic: transition[j, i] is the same probability, for mat-vec sweeps.
+        self.transition = self.forward.T.tocsr()
+
+
+    def teleport(self, indexes=None):
+        """
+        Teleport vector spread evenly over the given nodes, or over every node if None.
+        :param list indexes: positions of the nodes to restart at.
+        """
+        if indexes is None:
+            return np.full(self.n, 1 / self.n)
+        v = np.zeros(self.n)
+        v[np.asarray(indexes, dtype=np.int64)] = 1
+        return v / v.sum()
+
+
+    def teleports(self, groups):
+        """
+        Teleport matrix with one column per group of seed nodes, each spread evenly over its group.
+        :param list groups: list of lists of node positions, one list per column.
+        """
+        V = np.zeros((self.n, len(groups)))
+        for j, indexes in enumerate(groups):
+            V[np.asarray(indexes, dtype=np.int64), j] = 1
+        return V / V.sum(axis=0)
+
+
+    def solve(self, teleport=None, tol=1e-8, max_iter=100):
+        """
+        Iterates r = d (P r + (sink . r) v) + (1 - d) v with sparse mat-vec products until the L1
+            change between sweeps drops below tol. A teleport matrix runs one PPR per column in the
+            same sweeps, so each sweep is a single sparse mat-mat product.
+        :param numpy.ndarray teleport: (n,) restart distribution, or (n, L) with one per column. Each
+            is normalized to sum to 1. If None, uses the uniform distribution (plain PageRank).
+        :param float tol: L1 tolerance to stop at, checked on the worst column.
+        :param int max_iter: most sweeps to run.
+        :return PageRankResult: scores have the same shape as the teleport.
+        """
+        start = time()
+        v = self.teleport() if teleport is None else np.asarray(teleport, dtype=np.float64)
+        v = v / v.sum(axis=0)
+        d = self.damping
+
+        r = v.copy()
+        residuals = []
+        for _ in range(max_iter):
+            r_new = d * (self.transition.dot(r) + r[self.sink].sum(axis=0) * v) + (1 - d) * v
+            residuals.append(np.abs(r_new - r).sum(axis=0).max())
+            r = r_new
+            if residuals[-1] < tol:
+                break
+        return PageRankResult(r, len(residuals), residuals, time() - start)
+
+
+    def push(self, indexes, epsilon=1e-6):
+        """
+        Local personalized PageRank by forward push (Andersen, Chung and Lang). Mass moves out of a
+            node only while its residual exceeds epsilon times its out degree, so the cost depends
+            on the neighborhood explored around the seeds rather than on the size of the graph.
+        :param list indexes: positions of the seed nodes, weighted evenly.
+        :param float epsilon: residual threshold. Smaller is more accurate and explores further.
+        :return PageRankResult: scores for the pushed nodes only, see PageRankResult.nodes.
+        """
+        start = time()
+        d = self.damping
+        seeds = np.unique(np.asarray(indexes, dtype=np.int64))
+        seed_mass = np.full(len(seeds), 1 / len(seeds))
+        threshold = epsilon * np.maximum(self.degree, 1)
+
+        p = np.zeros(self.n)
+        r = np.zeros(self.n)
+        r[seeds] = seed_mass
+        queued = np.zeros(self.n, dtype=bool)
+        queue = deque(seeds[r[seeds] > threshold[seeds]].tolist())
+        queued[list(queue)] = True
+        pushed = []
+        residual = 1.0
+        residuals = []
+
+        while queue:
+            u = queue.popleft()
+            queued[u] = False
+            mass = r[u]
+            if not p[u]:
+                pushed.append(u)
+            p[u] += (1 - d) * mass
+            r[u] = 0
+            residual -= (1 - d) * mass
+            residuals.append(residual)
+
+            # spread the rest over the out edges, or back to the seeds from a sink.
+            if self.sink[u]:
+                targets, share = seeds, seed_mass
+            else:
+                begin, end = self.forward.indptr[u], self.forward.indptr[u + 1]
+                targets, share = self.forward.indices[begin:end], self.forward.data[begin:end]
+            r[targets] += d * mass * share
+            ready = targets[(r[targets] > threshold[targets]) & ~queued[targets]]
+            queued[ready] = True
+            queue.extend(ready.tolist())
+
+        nodes = np.array(pushed, dtype=np.int64)
+        return PageRankResult(p[nodes], len(residuals), residuals, time() - start, nodes=nodes)
+
+
+    @staticmethod
+    def walk_worker(indptr, indices, cumulative, sink, seeds, probs, damping, walks, seed):
+        """
+        Worker for each process of the Monte Carlo estimate. Advances a whole batch of walkers
+            together, stopping each with probability 1 - damping per step, and counts where the
+            walks end.
+        :param numpy.ndarray cumulative: per row running sum of transition probabilities, offset by
+            the row number so one searchsorted picks the next node of every walker.
+        :return numpy.ndarray: number of walks that ended at each node.
+        """
+        rng = np.random.RandomState(seed)
+        n = len(indptr) - 1
+        counts = np.zeros(n, dtype=np.int64)
+        position = seeds[rng.choice(len(seeds), size=walks, p=probs)]
+
+        while len(position):
+            stop = rng.random_sample(len(position)) >= damping
+            counts += np.bincount(position[stop], minlength=n)
+            position = position[~stop]
+
+            # sinks restart from the teleport distribution, the rest follow a weighted out edge.
+            at_sink = sink[position]
+            position[at_sink] = seeds[rng.choice(len(seeds), size=at_sink.sum(), p=probs)]
+            moving = position[~at_sink]
+            edge = np.searchsorted(cumulative, moving + rng.random_sample(len(moving)), side='right')
+            position[~at_sink] = indices[edge]
+        return counts
+
+
+    def monte_carlo(self, teleport=None, walks=100000, processes=None):
+        """
+        Approximate personalized PageRank from random walks with restart. Walkers start from the
+            teleport distribution and the share of walks ending at each node estimates its score,
+            so accuracy is set by the number of walks. Walks are sharded across a process pool.
+        :param numpy.ndarray teleport: (n,) restart distribution or (n, L) with one per column. If
+            None, uses the uniform distribution.
+        :param int walks: number of walks per teleport column.
+        :param int processes: number of worker processes. If None, uses every available core.
+        :return PageRankResult: residuals holds the largest standard error of the estimate.
+        """
+        start = time()
+        v = self.teleport() if teleport is None else np.asarray(teleport, dtype=np.float64)
+        v = v / v.sum(axis=0)
+        columns = v.reshape(self.n, -1)
+        processes = processes or cpu_count()
+
+        # running sum of each row's probabilities, forced to end at exactly 1, plus the row number.
+        f = self.forward
+        lengths = np.diff(f.indptr)
+        total = np.concatenate(([0], np.cumsum(f.data)))
+        cumulative = total[1:] - np.repeat(total[f.indptr[:-1]], lengths)
+        cumulative[f.indptr[1:][~self.sink] - 1] = 1
+        cumulative += np.repeat(np.arange(self.n), lengths)
+
+        share = ceil(walks / processes)
+        scores = np.zeros(columns.shape)
+        with Pool(processes) as p:
+            for j in range(columns.shape[1]):
+                seeds = np.flatnonzero(columns[:, j])
+                probs = columns[seeds, j]
+                args = [(f.indptr, f.indices, cumulative, self.sink, seeds, probs, self.damping,
+                         min(share, walks - i * share), np.random.randint(2 ** 31)) for i in range(processes)
+                        if walks - i * share > 0]
+                counts = sum(p.starmap(PageRank.walk_worker, args))
+                scores[:, j] = counts / walks
+
+        error = np.sqrt(scores * (1 - scores) / walks).max() if walks else float('nan')
+        return PageRankResult(scores.reshape(v.shape), walks, [error], time() - start)
+
+
+
+class PPRIndex():
+    """
+    Precomputed single source PPR. Row i holds the top M entries of u_i = (I - d P)^-1 e_i, the PPR
+        seeded at node i before it is normalized. PageRank.solve sends sink mass back through the
+        teleport vector, so its result is not linear in the teleport, but it is u / sum(u) and u is.
+        A query on a seed set adds the seeds' rows and divides by the sum of their full totals,
+        which costs a few sparse row reads instead of a solve.
+    """
+
+    def __init__(self, matrix, totals, digest=None):
+        """
+        :param scipy.sparse.csr_matrix matrix: (n, n) matrix of the top M entries of every u_i.
+        :param numpy.ndarray totals: (n,) sum of every full u_i.
+        :param str digest: PPRIndex.fingerprint of the engine the index was built with.
+        """
+        self.matrix = csr_matrix(matrix)
+        self.totals = np.asarray(totals, dtype=np.float64)
+        self.digest = digest
+
+
+    @staticmethod
+    def fingerprint(engine):
+        """
+        Digest of the engine's node count, damping and transitions, used to tell whether an index
+            belongs to the loaded graph.
+        """
+        forward = engine.forward.sorted_indices()
+        digest = md5(np.array([engine.n, engine.damping]).tobytes())
+        for array in (forward.indptr, forward.indices, forward.data):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+
+    def matches(self, engine):
+        """
+        Whether the index was built from this engine's graph.
+        """
+        return self.matrix.shape[0] == engine.n and self.digest == PPRIndex.fingerprint(engine)
+
+
+    @staticmethod
+    @timed
+    def build(engine, m=100, block=256, tol=1e-8, max_iter=100):
+        """
+        Computes every node's single source PPR, a block of seeds at a time with the batched solver,
+            and keeps the top m entries of each. A solved r_i is c_i u_i with c_i = d (sink . r_i) + 1 - d,
+            so u_i = r_i / c_i and its total is 1 / c_i.
+        :param PageRank engine: engine of the graph to index.
+        :param int m: number of scores to keep per node.
+        :param int block: number of seeds solved together.
+        """
+        n = engine.n
+        m = min(m, n)
+        d = engine.damping
+        rows, cols, data = [], [], []
+        totals = np.empty(n)
+        for start in range(0, n, block):
+            seeds = np.arange(start, min(start + block, n))
+            V = np.zeros((n, len(seeds)))
+            V[seeds, np.arange(len(seeds))] = 1
+            scores = engine.solve(V, tol=tol, max_iter=max_iter).scores.T
+            scale = d * scores[:, engine.sink].sum(axis=1) + 1 - d
+            scores /= scale[:, np.newaxis]
+            totals[seeds] = 1 / scale
+
+            best = np.argpartition(-scores, m - 1, axis=1)[:, :m]
+            rows.append(np.repeat(seeds, m))
+            cols.append(best.ravel())
+            data.append(np.take_along_axis(scores, best, axis=1).ravel())
+            print('Indexed PPR for %s of %s nodes.' % (seeds[-1] + 1, n))
+
+        matrix = csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+        matrix.eliminate_zeros()
+        return PPRIndex(matrix, totals, PPRIndex.fingerprint(engine))
+
+
+    def query(self, indexes):
+        """
+        PPR for the seed set from the sum of the seeds' stored rows.
+        :param list indexes: positions of the seed nodes.
+        :return PageRankResult: scores for the nodes present in the seeds' rows only.
+        """
+        start = time()
+        seeds = np.asarray(indexes, dtype=np.int64)
+        rows = self.matrix[seeds]
+        nodes, inverse = np.unique(rows.indices, return_inverse=True)
+        scores = np.bincount(inverse, weights=rows.data, minlength=len(nodes)) / self.totals[seeds].sum()
+        return PageRankResult(scores, 0, [], time() - start, nodes=nodes)
+
+
+    def save(self, location):
+        """
+        Saves the index as a numpy archive of the sparse matrix, totals and fingerprint.
+        :param path location: location to save to.
+        """
+        with open(location, 'wb+') as f:
+            np.savez(f, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                     shape=np.array(self.matrix.shape), totals=self.totals, fingerprint=np.array(self.digest))
+
+
+    @staticmethod
+    def load(location):
+        """
+        Load an index saved by PPRIndex.save.
+        :param path location: location to read from.
+        :return PPRIndex: the index, or None for archives written before the totals and fingerprint
+            were stored, which have to be rebuilt.
+        """
+        if not isfile(location):
+            raise FileNotFoundError('The location specified does not exist: %s' % location)
+        with np.load(location) as data:
+            if 'fingerprint' not in data:
+                return None
+            matrix = csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            return PPRIndex(matrix, data['totals'], str(data['fingerprint']))
+
+
+
+if __name__ == '__main__':
+    # Offline job: python pagerank.py <graph> [M]
+    #   saves the top M single source PPR of every node in the graph to <graph>_ppr.npz
+    from sparse_graph import SparseGraph
+    location = argv[1]
+    m = int(argv[2]) if len(argv) > 2 else 100
+    G, images = SparseGraph.load(location).get_adjacency(sparse=True)
+    index = PPRIndex.build(PageRank(G, damping=0.86), m)
+    index.save(location + '_ppr.npz')
@@ -0,0 +1,453 @@
+#! /bin/usr/python3.6
+from os import makedirs
+from os.path import isfile, isdir, join
+from util import timed
+import json
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sys import stdout
+from graph import Graph, Edge
+
+
+class SparseGraph():
+    """
+    Graph backed by a scipy CSR adjacency matrix and an id array. It offers the same interface as
+        Graph so the analytics tasks can run on it directly, and only builds an igraph Graph when
+        the graph is displayed.
+    """
+
+    # CONSTANTS DEFINITIONS
+    FORMAT = 'cse515-graph'
+    VERSION = 1
+
+    def __init__(self, ids=None, adjacency=None):
+        """
+        :param list ids: node names, one per row/column of the adjacency.
+        :param scipy.sparse.csr_matrix adjacency: weighted adjacency, rows are edge sources.
+        """
+        self.ids = np.asarray([] if ids is None else ids)
+        n = len(self.ids)
+        if adjacency is None:
+            adjacency = csr_matrix((n, n), dtype=np.float64)
+        if adjacency.shape != (n, n):
+            raise ValueError('Adjacency shape %s does not match the %s ids.' % (adjacency.shape, n))
+        self.adjacency = csr_matrix(adjacency)
+
+        # data structor to store nodes in a given cluster for faster access.
+        self.clusters = {}
+        # the cluster each node is currently displayed with, same as the Graph.CLUSTER attribute.
+        self.labels = [None] * n
+        # hash index from node name to row.
+        self.__index__ = {name: i for i, name in enumerate(self.ids.tolist())}
+
+
+
+    ###########################################################################################
+    ##  Low level background methods.
+    ###########################################################################################
+
+
+    def __get_index__(self, name):
+        """
+        retrieve the row of a node by its name.
+        :param obj name: identifier for this node.
+        """
+        try:
+            return self.__index__[name]
+        except KeyError:
+            raise ValueError('The node name provided couldn\'t be found or is repeated: %s' % name)
+
+
+    def __row__(self, i):
+        """
+        Column indices and weights of the out edges of row i.
+        :param int i: row of the node.
+        """
+        a = self.adjacency
+        start, end = a.indptr[i], a.indptr[i + 1]
+        return a.indices[start:end], a.data[start:end]
+
+
+    ###########################################################################################
+    ##  Interface methods
+    ###########################################################################################
+
+
+    def add_edges(self, edges):
+        """
+        Adds edges from an iterable
+        :param list edges: List of Edge objects.
+        """
+        if not isinstance(edges, list):
+            raise ValueError('Edges parameter should be a list of edge objects.')
+
+        src = np.array([edge.start for edge in edges])
+        dst = np.array([edge.end for edge in edges])
+        weights = np.array([edge.weight for edge in edges], dtype=np.float64)
+        self.add_edge_arrays(src, dst, weights)
+
+
+    def add_vertices(self, vertices):
+        """
+        Add vertices to graph by name.
+        :param list vertices: list of vertice names (can be any basic datatype)
+        """
+        if not isinstance(vertices, list):
+            raise ValueError('Vertices parameters should be a list of names.')
+
+        start = len(self.ids)
+        index = {vertex: start + i for i, vertex in enumerate(vertices)}
+        repeated = [vertex for vertex in index if vertex in self.__index__]
+        if repeated or len(index) != len(vertices):
+            raise ValueError('The node names provided are repeated: %s' % repeated)
+        self.__index__.update(index)
+
+        ids = self.ids.tolist() + vertices
+        self.ids = np.asarray(ids)
+        self.labels.extend([None] * len(vertices))
+        # new rows are empty, so only the row pointer grows.
+        a = self.adjacency
+        indptr = np.concatenate((a.indptr, np.repeat(a.indptr[-1], len(vertices))))
+        self.adjacency = csr_matrix((a.data, a.indices, indptr), shape=(len(ids), len(ids)))
+
+
+    def add_edge_arrays(self, src, dst, weights):
+        """
+        Adds edges in bulk from parallel arrays of names and weights. Each (src, dst) pair can be
+            added once, a repeated pair raises a ValueError instead of summing the weights, same as Graph.
+        :param numpy.ndarray src: names of the start nodes.
+        :param numpy.ndarray dst: names of the end nodes.
+        :param numpy.ndarray weights: weight of each edge.
+        """
+        if not len(src) == len(dst) == len(weights):
+            raise ValueError('Source, destination and weight arrays must be the same length.')
+
+        names = pd.Index(self.ids)
+        start = names.get_indexer(src)
+        end = names.get_indexer(dst)
+        if (start < 0).any() or (end < 0).any():
+            missing = np.concatenate((np.asarray(src)[start < 0], np.asarray(dst)[end < 0]))
+            raise ValueError('The node names provided couldn\'t be found: %s' % missing[:10])
+
+        existing = self.adjacency.tocoo()
+        repeated = Graph.repeated_edges(len(self.ids), np.column_stack((start, end)),
+                                        np.column_stack((existing.row, existing.col)))
+        if len(repeated):
+            raise ValueError('The edges provided are repeated: %s'
+                             % list(zip(np.asarray(src)[repeated[:10]].tolist(), np.asarray(dst)[repeated[:10]].tolist())))
+
+        new = csr_matrix((np.asarray(weights, dtype=np.float64), (start, end)), shape=self.adjacency.shape)
+        self.adjacency = self.adjacency + new
+
+
+    @timed
+    def add_similarity(self, similarity):
+        """
+        Adds similarity matrix information to the graph, with an edge from every photo to every other.
+        :param Pandas.Dataframe similarity: photo-photo similarity matrix
+        """
+        assert(all(similarity.index == similarity.columns))
+        self.add_vertices(list(similarity.index))
+        ids = np.asarray(similarity.index)
+        n = len(ids)
+        self.add_edge_arrays(np.repeat(ids, n), np.tile(ids, n), np.asarray(similarity.values).ravel())
+
+
+    @timed
+    def add_edge_dict(self, edge_dict):
+        """
+        initializes graph from an edge dictionary.
+        :param dict edge_dict: maps each node to a dictionary of {neighbor: weight}.
+        """
+        nodes = list(edge_dict.keys())
+        # form edges.
+        src = list()
+        dst = list()
+        weights = list()
+        for node in nodes:
+            src.extend([node] * len(edge_dict[node]))
+            dst.extend(edge_dict[node].keys())
+            weights.extend(edge_dict[node].values())
+        self.add_vertices(nodes)
+        self.add_edge_arrays(np.array(src), np.array(dst), np.array(weights))
+
+
+    def get_images(self):
+        return self.ids.tolist()
+
+
+    def node(self, name):
+        """
+        Get node by name. For this backend the node is its row in the adjacency matrix.
+        :param obj name: Name of node to retrieve.
+        """
+        return self.__get_index__(name)
+
+
+    def edge(self, src, end):
+        """
+        Get edge interface object between two nodes. Used to find weight of edge if it exists.
+        :param obj src: Name of start node, or tail.
+        :param obj end: Name of end node, or head.
+        """
+        indices, weights = self.__row__(self.__get_index__(src))
+        found = np.flatnonzero(indices == self.__get_index__(end))
+        if len(found):
+            return Edge(src, end, weights[found[0]])
+        # if edge doesn't exist.
+        return None
+
+
+    def subgraph(self, out_degree):
+        """
+        Returns a subgraph of this graph with max out degree of k.
+        When removing edges it keeps the largest k.
+        :param int out_degree: number of out edges for each vertex.
+        """
+        a = self.adjacency
+        keep = np.zeros(a.nnz, dtype=bool)
+        for i in range(a.shape[0]):
+            start, end = a.indptr[i], a.indptr[i + 1]
+            order = np.argsort(-a.data[start:end], kind='mergesort')[:out_degree]
+            keep[start + order] = True
+
+        rows = np.repeat(np.arange(a.shape[0]), np.diff(a.indptr))[keep]
+        adjacency = csr_matrix((a.data[keep], (rows, a.indices[keep])), shape=a.shape)
+        graph = SparseGraph(self.ids, adjacency)
+        graph.clusters = {cluster: list(nodes) for cluster, nodes in self.clusters.items()}
+        graph.labels = list(self.labels)
+        return graph
+
+
+    def neighbors(self, node, clusters=[]):
+        """
+        Returns the neighboring nodes to this one with the edge weight between them.
+        :param int node: id of node to find neighbors of.
+        :param list clusters: iterable of clusters to search for neighbors in.
+        :return list edges: returns list of edges to neighboring nodes, indicating the similarity.
+        """
+        indices, weights = self.__row__(self.__get_index__(node))
+
+        # if a set of clusters were specified, then limit neighbors to only those in the clusters.
+        if clusters:
+            members = set()
+            for cluster in clusters:
+                members.update(self.__get_index__(n) for n in self.clusters[cluster])
+            mask = np.array([i in members for i in indices], dtype=bool)
+            indices, weights = indices[mask], weights[mask]
+
+        # turn into Edge interface object.
+        names = self.ids[indices].tolist()
+        return [Edge(node, name, weight) for name, weight in zip(names, weights.tolist())]
+
+
+    def add_to_cluster(self, node, cluster):
+        """
+        Adds cluster label to the node. NOTE: If node is already in a cluster, this will be
+            overwritten in the label used for display. The previous cluster will be restored
+            when the node is removed from the new cluster.
+        :param int node: node id to add label to.
+        :param str cluster: cluster identifier to add to node.
+        """
+        # if this is an iterable of nodes, run code for each.
+        if isinstance(node, list):
+            for n in node:
+                self.add_to_cluster(n, cluster)
+            return
+
+        # Add to local specification.
+        if not cluster in self.clusters:
+            self.clusters[cluster] = list()
+        self.clusters[cluster].append(node)
+        self.labels[self.__get_index__(node)] = cluster
+
+
+    def remove_from_cluster(self, node, cluster):
+        """
+        Removes node from cluster. This sets the label to another cluster if the node belongs to a
+            second one, or None otherwise.
+        :param int node: node id to add label to.
+        :param str cluster: cluster identifier to remove from.
+        """
+        if not cluster in self.clusters:
+            raise ValueError("Cluster specified doesn't exist: %s" % cluster)
+
+        if isinstance(node, list):
+            for n in node:
+                self.remove_from_cluster(n, cluster)
+            return
+
+        self.clusters[cluster].remove(node)
+        # see if this has any alternative labels in the clusters dictionary.
+        c = None
+        for cluster, l in self.clusters.items():
+            if node in l:
+                c = cluster
+                break
+        self.labels[self.__get_index__(node)] = c
+
+
+    def clear_clusters(self):
+        """
+        Deletes cluster data from graph.
+        """
+        self.clusters = {}
+        self.labels = [None] * len(self.ids)
+
+
+    def get_adjacency(self, weighted=False, sparse=False):
+        """
+        Adjacency matrix as a DataFrame indexed by the node names, like Graph.get_adjacency.
+        :param bool weighted: use the edge weights instead of 1 for each edge.
+        :param bool sparse: return (matrix, ids) with the CSR matrix itself instead of a DataFrame.
+        """
+        a = self.adjacency
+        if not weighted:
+            a = csr_matrix((np.ones(a.nnz, dtype=np.int64), a.indices, a.indptr), shape=a.shape)
+        labels = self.get_images()
+        if sparse:
+            return a, labels
+        return pd.DataFrame(data=a.toarray(), index=labels, columns=labels)
+
+
+    def to_graph(self):
+        """
+        Build the equivalent igraph backed Graph, clusters included.
+        """
+        a = self.adjacency.tocoo()
+        g = Graph()
+        g.add_vertices(self.get_images())
+        g.add_edge_arrays(self.ids[a.row], self.ids[a.col], a.data)
+        g.__graph__.vs[Graph.CLUSTER] = list(self.labels)
+        g.clusters = {cluster: list(nodes) for cluster, nodes in self.clusters.items()}
+        return g
+
+
+    @staticmethod
+    def from_graph(graph):
+        """
+        Build a SparseGraph from an igraph backed Graph, clusters included.
+        :param Graph graph: graph to convert.
+        """
+        g = graph.__graph__
+        ids = graph.get_images()
+        n = len(ids)
+        edges = np.array(g.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+        weights = np.array(g.es[Graph.SIM] if g.ecount() else [], dtype=np.float64)
+        adjacency = csr_matrix((weights, (edges[:, 0], edges[:, 1])), shape=(n, n))
+
+        sparse = SparseGraph(ids, adjacency)
+        sparse.clusters = {cluster: list(nodes) for cluster, nodes in graph.clusters.items()}
+        if Graph.CLUSTER in g.vs.attributes():
+            sparse.labels = g.vs[Graph.CLUSTER]
+        return sparse
+
+
+    @staticmethod
+    def from_knn_table(table, k):
+        """
+        Build the k nearest neighbor graph of a KNNTable straight into CSR form. Every row has
+            exactly k edges, so the row pointer is a range and the arrays are used as they are.
+        :param KNNTable table: nearest neighbor family to take the graph from.
+        :param int k: number of neighbors per node.
+        """
+        neighbors, weights = table.view(k)
+        n = len(table.ids)
+        adjacency = csr_matrix((weights.ravel().astype(np.float64), neighbors.ravel(),
+                                np.arange(0, n * k + 1, k)), shape=(n, n))
+        adjacency.sort_indices()
+        return SparseGraph(table.ids, adjacency)
+
+
+    def display(self, clusters=[], filename='out.png', emphasis=[], emph_color=None):
+        """
+        Show representation of the graph. Converts to an igraph backed Graph and uses its display,
+            see Graph.display for the parameters.
+        """
+        self.to_graph().display(clusters=clusters, filename=filename, emphasis=emphasis,
+                                emph_color=emph_color)
+
+
+    def display_clusters_text(self, clusters=None, keys=None, file=stdout):
+        """
+        Show clusters as text. See Graph.display_clusters_text.
+        """
+        Graph.display_clusters_text(self, clusters, keys, file)
+
+
+    def nodes_in_cluster(self, cluster):
+        """
+        Get all nodes in the cluster specified.
+        :param obj cluster: cluster identifier.
+        """
+        return self.clusters[cluster]
+
+
+    def save(self, location):
+        """
+        Saves graph as a snapshot directory of raw numpy arrays that load() can memory map:
+            meta.json     format version, sizes and the cluster keys.
+            ids.npy       node name of each row.
+            indptr.npy, indices.npy, weights.npy    the CSR adjacency.
+            clusters.npy  int32 position in the cluster keys of each node's label, -1 for none.
+        NOTE: Only each node's current label is kept, so overlapping cluster membership is lost.
+        :param path location: directory to save to.
+        """
+        if not isdir(location):
+            makedirs(location)
+
+        a = self.adjacency
+        keys = list(self.clusters.keys())
+        for label in self.labels:
+            if not label is None and not label in keys:
+                keys.append(label)
+        codes = {key: i for i, key in enumerate(keys)}
+        labels = np.array([-1 if label is None else codes[label] for label in self.labels], dtype=np.int32)
+
+        np.save(join(location, 'ids.npy'), self.ids)
+        np.save(join(location, 'indptr.npy'), a.indptr)
+        np.save(join(location, 'indices.npy'), a.indices)
+        np.save(join(location, 'weights.npy'), a.data)
+        np.save(join(location, 'clusters.npy'), labels)
+        meta = {'format': SparseGraph.FORMAT, 'version': SparseGraph.VERSION, 'nodes': len(self.ids),
+                'edges': int(a.nnz), 'cluster_keys': [getattr(key, 'item', lambda: key)() for key in keys]}
+        with open(join(location, 'meta.json'), 'w+') as f:
+            json.dump(meta, f)
+
+
+    @staticmethod
+    def load(location, mmap_mode='r'):
+        """
+        Load graph from a snapshot directory written by SparseGraph.save. The arrays are memory
+            mapped, so opening a large graph is immediate and several processes share the pages.
+            Also reads the igraph pickles written by Graph.save.
+        :param path location: location to read from.
+        :param str mmap_mode: numpy memory map mode, None reads the arrays into memory instead.
+        """
+        if isfile(location):
+            return SparseGraph.from_graph(Graph.load(location))
+        if not isfile(join(location, 'meta.json')):
+            raise FileNotFoundError('The location specified does not exist: %s' % location)
+
+        with open(join(location, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta.get('format') != SparseGraph.FORMAT or meta.get('version', 0) > SparseGraph.VERSION:
+            raise ValueError('Unsupported graph snapshot %s version %s at %s' % \
+                             (meta.get('format'), meta.get('version'), location))
+
+        def array(name):
+            return np.load(join(location, name + '.npy'), mmap_mode=mmap_mode)
+
+        ids = array('ids')
+        n = meta['nodes']
+        adjacency = csr_matrix((array('weights'), array('indices'), array('indptr')), shape=(n, n))
+        graph = SparseGraph(ids, adjacency)
+
+        # rebuild the clusters dictionary from the label array.
+        keys = meta['cluster_keys']
+        labels = np.asarray(array('clusters'))
+        graph.labels = [None if code < 0 else keys[code] for code in labels.tolist()]
+        for i, key in enumerate(keys):
+            graph.clusters[key] = ids[labels == i].tolist()
+        return graph
@@ -1,128 +1,494 @@
-import numpy as np
-import pandas as pd
-from distance import Distance
-from database import Database
-from neighbor import Neighbor
-
-
-class LSH():
-
-    def get_random_vectors(self, L, k):
-        random_vectors = {}
-        for i in range(L):
-            for j in range(k):
-                random_vectors[i, j] = np.random.randint(0, 9, size=(2, 945)) * 0.1
-        return random_vectors
-
-    def get_distances(self, vectors, image_dict):
-        results = {}
-        result = []
-        for i in vectors:
-            print("Working on hash" + str(i))
-            dist = {}
-            projection = []
-            for image in image_dict:
-                a = np.array(vectors[i], dtype=np.float)
-                b = a[1]
-                a = a[0]
-                p = np.array(image_dict[image], dtype=np.float)
-                ap = p - a
-                ab = b - a
-                # distance = np.array(np.around((ab * ap) / Distance.E2_distance(a, b), decimals=4))
-                projection.append(np.array(np.around((a + np.dot(ab, ap) / np.dot(ab, ab) * ab), decimals=3)))
-                # projection.append(np.array(np.around()))
-            min_proj = np.amin(projection, axis=0)
-            image_keys = list(image_dict.keys())
-            j = 0
-            # print(min_proj)
-            for x in projection:
-                distance = Distance.E2_distance(min_proj, x)
-                ind = image_keys[j]
-                dist[ind] = distance
-                j = j + 1
-            result.append(dist)
-            results['h' + str(i)] = result
-            result = []
-        # print(results)
-        return results
-
-
-    def get_buckets(self, results, num_buckets=4):
-        buckets = {}
-        for result in results:
-            hash = results[result]
-            for images in hash:
-                # print(images)
-                distances = list(images.values())
-                # print(distances)
-                distances = np.around(np.array(distances, dtype=np.float), decimals=3)
-                dist = (np.amax(distances) - np.amin(distances)) / num_buckets
-                bucket_range = range(int(np.amin(distances)), int(np.amax(distances)), int(dist))
-                # print(bucket_range)
-                bucket = {}
-                for i in range(num_buckets):
-                    bucket[str(i)] = []
-                for image in images:
-                    # print(images[image])
-                    x = images[image]
-                    j = -1
-                    for b in bucket_range:
-                        # print(b)
-                        if x < b:
-                            bucket[str(j)].append(image)
-                            break
-                        j = j + 1
-                buckets[result] = bucket
-                break
-        # print(buckets)
-        return buckets
-
-    def get_index_structure(self, L, k, image_dict):
-
-        random_vectors = self.get_random_vectors(L, k)
-
-        # projection code
-        results = self.get_distances(random_vectors, image_dict)
-
-        # bucketing code
-        num_buckets = 30
-        buckets = self.get_buckets(results, num_buckets)
-
-        return buckets, random_vectors
-
-    def main(self, L=2, k=3, imageId=5175916261, vectors=[], t=5, database=()):
-        imageId = imageId[0]
-        imageId = int(imageId[1:-1])
-        image_dict = pd.DataFrame(database.get_vis_table())
-        image_dict = image_dict.T
-        image_dict = image_dict.to_dict('list')
-
-        index_structure, vectors = self.get_index_structure(L, k, image_dict)
-        # print(index_structure['h(0, 0)'])
-
-        # get all the imageIds which are in the same bucket as the given imageId
-        imageId_set = set(image_dict.keys())
-        # print(imageId_set)
-        for i in range(L):
-            for j in range(k):
-                temp_imageId = set()
-                for bucket in index_structure['h(' + str(i) + ', ' + str(j) + ')']:
-                    if imageId in index_structure['h(' + str(i) + ', ' + str(j) + ')'][str(bucket)]:
-                        temp_imageId = temp_imageId.union(set(index_structure['h(' + str(i) + ', ' + str(j) + ')'][str(bucket)]))
-                imageId_set = imageId_set.intersection(temp_imageId)
-        # print(imageId_set)
-
-        # calculate similarity and get t nearest images
-
-        nearest, num_comparisons = Neighbor.knn_visual_LSH(t, imageId, database, list(imageId_set))
-
-        print("Number of images compared: " + str(num_comparisons))
-        for image in nearest:
-            print(image)
-
-        exit(1)
-
-
-if __name__ == '__main__':
-    lsh = LSH()
-    lsh.main()
+import numpy as np
+import pandas as pd
+from hashlib import md5
+from heapq import heappush, heappop, merge
+from itertools import islice
+from os.path import isfile, join
+from sys import getsizeof
+from time import time
+from util import timed
+from database import Database
+from distance import Distance
+from neighbor import Neighbor
+
+
+class LSHIndex():
+    """
+    Random projection LSH over the rows of a feature matrix. Each of the L layers hashes a row to a
+        tuple of k bucket numbers, one per random direction, with the projected range split into
+        num_buckets equal widths. Rows sharing a tuple in any layer are candidates for each other.
+    """
+
+    def __init__(self, L, k, num_buckets=30, seed=None):
+        """
+        :param int L: number of layers (hash tables).
+        :param int k: number of hashes per layer.
+        :param int num_buckets: number of buckets the projected range of each hash is split into.
+        :param int seed: random seed for the projections.
+        """
+        self.L = L
+        self.k = k
+        self.num_buckets = num_buckets
+        self.seed = seed
+        self.projections = None
+        self.offsets = None
+        self.widths = None
+        self.tables = []
+        # fingerprint of the features the index was built from, see LSHIndex.fingerprint.
+        self.digest = None
+
+
+    @timed
+    def build(self, matrix):
+        """
+        Hashes every row of the matrix with one matrix product per layer and stores the buckets as
+            dictionaries from hash tuple to int32 row positions.
+        :param numpy.ndarray matrix: (n, d) feature matrix.
+        """
+        n, d = matrix.shape
+        rng = np.random.RandomState(self.seed)
+        self.projections = rng.normal(size=(self.L, d, self.k))
+        self.offsets = np.empty((self.L, self.k))
+        self.widths = np.empty((self.L, self.k))
+        self.tables = []
+
+        for layer in range(self.L):
+            projected = matrix.dot(self.projections[layer])
+            low, high = projected.min(axis=0), projected.max(axis=0)
+            width = (high - low) / self.num_buckets
+            width[width == 0] = 1
+            self.offsets[layer], self.widths[layer] = low, width
+            codes = self.__codes__(projected, layer)
+
+            # group rows by identical code tuples.
+            keys, inverse = np.unique(codes, axis=0, return_inverse=True)
+            inverse = np.ravel(inverse)
+            order = np.argsort(inverse, kind='mergesort').astype(np.int32)
+            groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+            self.tables.append({tuple(key): group for key, group in zip(keys.tolist(), groups)})
+        return self
+
+
+    def __codes__(self, projected, layer):
+        """
+        Bucket numbers of projected rows for one layer.
+        """
+        return np.floor((projected - self.offsets[layer]) / self.widths[layer]).astype(np.int64)
+
+
+    def hash(self, vector):
+        """
+        Hash tuples of a query vector, one per layer.
+        :param numpy.ndarray vector: (d,) query vector.
+        """
+        return [tuple(self.__codes__(vector.dot(self.projections[layer]), layer).tolist())
+                for layer in range(self.L)]
+
+
+    def hash_batch(self, matrix):
+        """
+        Bucket numbers of many query vectors for every layer with a single matrix product.
+        :param numpy.ndarray matrix: (q, d) query vectors.
+        :return numpy.ndarray: (L, q, k) bucket numbers.
+        """
+        d = self.projections.shape[1]
+        projected = matrix.dot(self.projections.transpose(1, 0, 2).reshape(d, self.L * self.k))
+        projected = projected.reshape(len(matrix), self.L, self.k).transpose(1, 0, 2)
+        return np.floor((projected - self.offsets[:, None]) / self.widths[:, None]).astype(np.int64)
+
+
+    def __probes__(self, vector, layer):
+        """
+        Neighboring buckets of the query in one layer, best first (multi-probe LSH, Lv et al.).
+            Moving hash j down a bucket costs the squared distance from the query to the lower
+            boundary, in bucket widths, and up a bucket the distance to the upper one. Sets of
+            moves are generated in increasing total cost with a heap of shift/expand steps.
+        :return generator: (score, layer, key) for every perturbed bucket.
+        """
+        position = (vector.dot(self.projections[layer]) - self.offsets[layer]) / self.widths[layer]
+        home = np.floor(position)
+        fraction = position - home
+        # the 2k single moves (cost, hash, delta), cheapest first.
+        moves = sorted([(f ** 2, j, -1) for j, f in enumerate(fraction)] +
+                       [((1 - f) ** 2, j, 1) for j, f in enumerate(fraction)])
+        home = home.astype(np.int64)
+
+        heap = [(moves[0][0], (0,))]
+        while heap:
+            score, chosen = heappop(heap)
+            last = chosen[-1]
+            if last + 1 < len(moves):
+                # shift replaces the last move with the next one, expand adds the next one.
+                heappush(heap, (score - moves[last][0] + moves[last + 1][0], chosen[:-1] + (last + 1,)))
+                heappush(heap, (score + moves[last + 1][0], chosen + (last + 1,)))
+            hashes = [moves[i][1] for i in chosen]
+            # moving the same hash both up and down is not a bucket.
+            if len(set(hashes)) == len(hashes):
+                key = home.copy()
+                for i in chosen:
+                    key[moves[i][1]] += moves[i][2]
+                yield score, layer, tuple(key.tolist())
+
+
+    def query(self, vector, probes=0):
+        """
+        Candidate rows for a query vector: every row sharing its bucket in at least one layer.
+        :param numpy.ndarray vector: (d,) query vector.
+        :param int probes: number of extra neighboring buckets to visit, across all layers, in order
+            of their perturbation score. Lets fewer layers reach the same recall.
+        :return numpy.ndarray: sorted int32 row positions.
+        """
+        empty = np.array([], dtype=np.int32)
+        buckets = [table.get(key, empty) for table, key in zip(self.tables, self.hash(vector))]
+        if probes:
+            perturbed = merge(*[self.__probes__(vector, layer) for layer in range(self.L)])
+            buckets.extend(self.tables[layer].get(key, empty) for _, layer, key in islice(perturbed, probes))
+        return np.unique(np.concatenate(buckets)) if buckets else empty
+
+
+    def query_batch(self, matrix, probes=0):
+        """
+        Candidate rows for many query vectors, hashed together with LSHIndex.hash_batch.
+        :param numpy.ndarray matrix: (q, d) query vectors.
+        :param int probes: number of extra neighboring buckets to visit per query.
+        :return list: sorted int32 row positions for every query.
+        """
+        empty = np.array([], dtype=np.int32)
+        codes = self.hash_batch(matrix).tolist()
+        candidates = []
+        for i, vector in enumerate(matrix):
+            buckets = [table.get(tuple(codes[layer][i]), empty) for layer, table in enumerate(self.tables)]
+            if probes:
+                perturbed = merge(*[self.__probes__(vector, layer) for layer in range(self.L)])
+                buckets.extend(self.tables[layer].get(key, empty) for _, layer, key in islice(perturbed, probes))
+            candidates.append(np.unique(np.concatenate(buckets)) if buckets else empty)
+        return candidates
+
+
+    @staticmethod
+    def fingerprint(ids, matrix):
+        """
+        Digest of the ids and features, used to tell whether a saved index is still valid.
+        """
+        digest = md5(np.ascontiguousarray(ids).tobytes())
+        digest.update(np.ascontiguousarray(matrix).tobytes())
+        return digest.hexdigest()
+
+
+    def save(self, location):
+        """
+        Saves the projections and bucket tables to a numpy archive.
+        :param path location: location to save to.
+        """
+        arrays = {'params': np.array([self.L, self.k, self.num_buckets]), 'projections': self.projections,
+                  'offsets': self.offsets, 'widths': self.widths, 'fingerprint': np.array(self.digest)}
+        for layer, table in enumerate(self.tables):
+            arrays['keys%s' % layer] = np.array(list(table.keys()), dtype=np.int64).reshape(-1, self.k)
+            arrays['sizes%s' % layer] = np.array([len(rows) for rows in table.values()], dtype=np.int64)
+            arrays['rows%s' % layer] = np.concatenate(list(table.values()))
+        with open(location, 'wb+') as f:
+            np.savez(f, **arrays)
+
+
+    @staticmethod
+    def load(location):
+        """
+        Load an index saved by LSHIndex.save.
+        :param path location: location to read from.
+        """
+        if not isfile(location):
+            raise FileNotFoundError('The location specified does not exist: %s' % location)
+        with np.load(location) as data:
+            L, k, num_buckets = data['params'].tolist()
+            index = LSHIndex(L, k, num_buckets)
+            index.projections, index.offsets, index.widths = data['projections'], data['offsets'], data['widths']
+            index.digest = str(data['fingerprint'])
+            for layer in range(L):
+                groups = np.split(data['rows%s' % layer], np.cumsum(data['sizes%s' % layer])[:-1])
+                index.tables.append({tuple(key): rows for key, rows in zip(data['keys%s' % layer].tolist(), groups)})
+        return index
+
+
+
+class SimHashIndex():
+    """
+    Random hyperplane signatures over the rows of a feature matrix. Each row keeps one sign bit per
+        hyperplane, packed into uint64 words, and the Hamming distance between two signatures
+        estimates the angle between the rows. Scanning every signature is far cheaper than the
+        exact distance, so it makes a first stage that picks candidates for the rerank.
+    """
+
+    # number of set bits in every byte value.
+    POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def __init__(self, bits=256, seed=None):
+        """
+        :param int bits: number of hyperplanes, rounded up to a multiple of 64.
+        :param int seed: random seed for the hyperplanes.
+        """
+        self.bits = -(-bits // 64) * 64
+        self.seed = seed
+        self.planes = None
+        self.center = None
+        self.signatures = None
+
+
+    @timed
+    def build(self, matrix):
+        """
+        Signs every row of the matrix with one matrix product.
+        :param numpy.ndarray matrix: (n, d) feature matrix.
+        """
+        rng = np.random.RandomState(self.seed)
+        self.planes = rng.normal(size=(matrix.shape[1], self.bits))
+        # the features are non-negative, centering them spreads the rows around the hyperplanes.
+        self.center = matrix.mean(axis=0)
+        self.signatures = self.sign(matrix)
+        return self
+
+
+    def sign(self, matrix):
+        """
+        Packed signatures of the rows of a matrix, or of a single vector.
+        :return numpy.ndarray: (n, bits / 64) uint64 words.
+        """
+        bits = (np.atleast_2d(matrix) - self.center).dot(self.planes) > 0
+        return np.packbits(bits, axis=1).view(np.uint64)
+
+
+    def hamming(self, vector):
+        """
+        Hamming distance from the signature of a query vector to every stored signature.
+        :param numpy.ndarray vector: (d,) query vector.
+        :return numpy.ndarray: (n,) number of differing bits.
+        """
+        xor = np.bitwise_xor(self.signatures, self.sign(vector))
+        return self.POPCOUNT[xor.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+
+    def query(self, vector, candidates=100):
+        """
+        Rows whose signatures are closest to the query's.
+        :param numpy.ndarray vector: (d,) query vector.
+        :param int candidates: number of rows to return.
+        :return numpy.ndarray: int32 row positions, closest first.
+        """
+        distances = self.hamming(vector)
+        if candidates < len(distances):
+            rows = np.argpartition(distances, candidates - 1)[:candidates]
+        else:
+            rows = np.arange(len(distances))
+        return rows[np.argsort(distances[rows], kind='mergesort')].astype(np.int32)
+
+
+
+class LSH():
+    """
+    Task 5 driver. Keeps the LSH indexes built in this session in memory and saves them next to the
+        visual data, so an index is only rebuilt when L, k or the features change. SimHash indexes
+        are cheap to build and only kept in memory.
+    """
+
+    def __init__(self, folder='saved'):
+        """
+        :param path folder: folder to save the indexes in, the same one the visual data is saved in.
+        """
+        self.folder = folder
+        self.indexes = {}
+        self.simhashes = {}
+
+
+    def get_index(self, L, k, database):
+        """
+        LSH index over the visual features for L layers of k hashes. Reuses the one in memory, then
+            the one on disk if it was built from the same features, and builds and saves it otherwise.
+        """
+        ids, matrix = database.get_vis_matrix()
+        if (L, k) in self.indexes and self.indexes[L, k][0] is matrix:
+            return self.indexes[L, k][1]
+
+        digest = LSHIndex.fingerprint(ids, matrix)
+        location = join(self.folder, 'lsh_%s_%s.npz' % (L, k))
+        index = LSHIndex.load(location) if isfile(location) else None
+        if index is None or index.digest != digest:
+            index = LSHIndex(L, k).build(matrix)
+            index.digest = digest
+            index.save(location)
+            print('LSH index saved to %s' % location)
+
+        self.indexes[L, k] = (matrix, index)
+        return index
+
+
+    def get_simhash(self, bits, database):
+        """
+        SimHash index over the visual features with the given number of bits, rebuilt when the
+            features change.
+        """
+        ids, matrix = database.get_vis_matrix()
+        if bits not in self.simhashes or self.simhashes[bits][0] is not matrix:
+            self.simhashes[bits] = (matrix, SimHashIndex(bits, seed=0).build(matrix))
+        return self.simhashes[bits][1]
+
+
+    @staticmethod
+    def index_size(index):
+        """
+        Approximate memory of an LSH index in bytes: the arrays plus the dictionaries and their keys.
+        """
+        size = index.projections.nbytes + index.offsets.nbytes + index.widths.nbytes
+        for table in index.tables:
+            size += getsizeof(table) + sum(getsizeof(key) + rows.nbytes for key, rows in table.items())
+        return size
+
+
+    def benchmark(self, database, layers=(1, 2, 4, 8), hashes=(2, 4, 8), buckets=(10, 30, 100),
+                  t=5, queries=100, probes=0, seed=0, processes=1):
+        """
+        Recall against cost for a grid of LSH parameters. Every combination of L, k and number of
+            buckets is built from scratch and queried with the same sample of images, and its
+            reranked top t is compared with the exact top t over every image.
+        :param int t: number of nearest images to find.
+        :param int queries: number of query images sampled.
+        :param int probes: extra buckets visited per query, see LSHIndex.query.
+        :param int processes: workers for the exact search, through the session pool of Neighbor.get_pool.
+        :return pandas.DataFrame: one row per combination with its recall@t, mean candidates,
+            build time (s), index memory (MB) and mean query latency (ms).
+        """
+        if processes > 1:
+            # start the pool first, so the matrix below is already the shared copy.
+            Neighbor.get_pool(database, processes)
+        ids, matrix = database.get_vis_matrix()
+        rng = np.random.RandomState(seed)
+        sample = rng.choice(len(ids), min(queries, len(ids)), replace=False)
+
+        # exact top t with the same distance and column cut as the rerank.
+        if processes > 1:
+            pool = Neighbor.get_pool(database, processes)
+            truth = [set(pool.query(t, matrix[row, cols], cols).ids.tolist())
+                     for row, cols in ((row, matrix[row].nonzero()[0]) for row in sample)]
+        else:
+            queries = matrix[sample]
+            exact, _ = Distance.l_p_pairwise(3, queries, matrix, k=t, mask=queries != 0)
+            truth = [set(ids[rows].tolist()) for rows in exact]
+
+        results = []
+        for L in layers:
+            for k in hashes:
+                for num_buckets in buckets:
+                    start = time()
+                    index = LSHIndex(L, k, num_buckets, seed=seed).build(matrix)
+                    build = time() - start
+
+                    found, examined, start = 0, 0, time()
+                    for row, exact in zip(sample, truth):
+                        candidates = index.query(matrix[row], probes=probes)
+                        cols = matrix[row].nonzero()[0]
+                        distances = Distance.l_p_distance(3, matrix[row, cols], matrix[candidates][:, cols])
+                        nearest = candidates[np.argsort(distances, kind='mergesort')[:t]]
+                        found += len(exact.intersection(ids[nearest].tolist()))
+                        examined += len(candidates)
+                    latency = (time() - start) / len(sample)
+
+                    results.append((L, k, num_buckets, found / (t * len(sample)), examined / len(sample),
+                                    build, self.index_size(index) / 2 ** 20, latency * 1000))
+
+        return pd.DataFrame(results, columns=['L', 'k', 'buckets', 'recall', 'candidates',
+                                              'build_s', 'memory_mb', 'latency_ms'])
+
+
+    def batch(self, L, k, imageIds, t, database, probes=0, simhash=0, bits=256, output='task5.csv', exact=False):
+        """
+        Nearest images for many queries at once. The queries are hashed together, their candidates
+            reranked in blocks by Neighbor.knn_visual_batch, and the results written to a CSV file
+            with one line per query, rank, image and distance.
+        :param list imageIds: ids of the query images.
+        :param path output: CSV file to write.
+        :param bool exact: find the exact nearest images with the pivot index instead of LSH.
+        :return pandas.DataFrame: the results written.
+        """
+        ids, matrix = database.get_vis_matrix()
+        rows = pd.Index(ids).get_indexer([int(str(image).strip('\'"[],')) for image in imageIds])
+        if (rows < 0).any():
+            raise ValueError('The images %s could not be found' % [imageIds[i] for i in np.flatnonzero(rows < 0)])
+
+        if exact:
+            index = Neighbor.get_pivot_index(database)
+            nearest, compared = [], 0
+            for vector in matrix[rows]:
+                nearest.append(index.query(t, vector))
+                compared += index.evaluated
+        else:
+            if simhash:
+                index = self.get_simhash(bits, database)
+                candidates = [index.query(vector, candidates=simhash) for vector in matrix[rows]]
+            else:
+                candidates = self.get_index(L, k, database).query_batch(matrix[rows], probes=probes)
+            nearest = Neighbor.knn_visual_batch(t, rows, database, candidates)
+            compared = sum(len(c) for c in candidates)
+        table = pd.DataFrame({'query': np.repeat(ids[rows], [len(n) for n in nearest]),
+                              'rank': np.concatenate([np.arange(1, len(n) + 1) for n in nearest]),
+                              'image': np.concatenate([n.ids for n in nearest]),
+                              'distance': np.concatenate([n.distances for n in nearest])},
+                             columns=['query', 'rank', 'image', 'distance'])
+        table.to_csv(output, index=False)
+        print("Number of images compared: %s over %s queries" % (compared, len(rows)))
+        print('Results saved to %s' % output)
+        return table
+
+
+    def main(self, L=2, k=3, imageId=5175916261, vectors=[], t=5, database=(), probes=0, simhash=0, bits=256,
+             exact=False):
+        imageId = imageId[0]
+        imageId = int(str(imageId).strip('\'"[]'))
+        if exact:
+            # exact L3 over all the columns, the pivot index skips the images that cannot be nearest.
+            nearest = Neighbor.knn_visual_exact(t, imageId, database)
+            print(nearest)
+            return nearest
+        ids, matrix = database.get_vis_matrix()
+        row = np.flatnonzero(ids == imageId)
+        if not len(row):
+            raise ValueError('The image %s could not be found' % imageId)
+
+        if simhash:
+            # get the imageIds with the closest signatures to the given imageId.
+            candidates = self.get_simhash(bits, database).query(matrix[row[0]], candidates=simhash)
+        else:
+            index = self.get_index(L, k, database)
+
+            # get all the imageIds which share a bucket with the given imageId in some layer.
+            candidates = index.query(matrix[row[0]], probes=probes)
+
+        # calculate similarity and get t nearest images
+
+        nearest, num_comparisons = Neighbor.knn_visual_LSH(t, row[0], database, candidates)
+
+        print("Number of images compared: " + str(num_comparisons))
+        print(nearest)
+        return nearest
+
+
+if __name__ == '__main__':
+    # Offline job: python task5.py [--layers # ..] [--hashes # ..] [--buckets # ..] [--csv file]
+    #   sweeps the LSH parameters over the visual data saved in ./saved and reports recall and cost.
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--hashes', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--buckets', type=int, nargs='+', default=[10, 30, 100])
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--probes', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--csv', type=str, metavar='filename')
+    args = parser.parse_args()
+
+    db = Database()
+    if not db.load_vis():
+        raise FileNotFoundError('No saved visual data found, load a dataset from main.py first.')
+    table = LSH().benchmark(db, args.layers, args.hashes, args.buckets, args.k, args.queries, args.probes,
+                            processes=args.processes)
+    print(table.to_string(index=False))
+    if args.csv:
+        table.to_csv(args.csv, index=False)